@@ -14,6 +14,7 @@ from tqdm import tqdm
 import sys
 sys.path.append('..')
 from helpers.losses import *
+from helpers.metrics import batch_dice
 from helpers.utils import load_vol_brats
 
 class intervention():
@@ -46,6 +47,8 @@ class intervention():
 
 				prediction = np.argmax(self.model.predict(test_image[None, ...]), axis = -1)[0]
 				print("Original Dice Whole:", dice_whole_coef(prediction, gt))
+				label_dice = batch_dice(gt[None, ...], prediction[None, ...], 
+								{j: (j,) for j in range(n_classes)})[0]
 
 				class_dict = {0:'bg', 1:'core', 2:'edema', 3:'enhancing'}
 
@@ -58,8 +61,9 @@ class intervention():
 						test_image_intervention[gt == j] += (new_mean - old_mean)
 						prediction_intervention = np.argmax(self.model.predict(test_image_intervention[None, ...]), axis = -1)[0]
 
-						corr[i,j] += dice_label_coef(prediction, gt, (j,)) - dice_label_coef(prediction_intervention, gt, (j,))
-						corr_temp[i,j] += dice_label_coef(prediction, gt, (j,)) - dice_label_coef(prediction_intervention, gt, (j,))
+						delta = label_dice[j] - batch_dice(gt[None, ...], prediction_intervention[None, ...], {j: (j,)})[0, 0]
+						corr[i,j] += delta
+						corr_temp[i,j] += delta
 						
 						if plot == True:
 							plt.subplot(n_classes, n_classes, 1+4*i+j)
@@ -142,10 +146,12 @@ class intervention():
 
 		delta_image_perc = (np.mean(np.abs(image - adverserial_image))*100)/np.ptp(image)
 
-		delta_dice_perc = (dice_whole_coef(self.model.predict(image).argmax(axis=-1), 
-			gt) - dice_whole_coef(self.model.predict(adverserial_image).argmax(axis=-1), 
-			gt))*100/dice_whole_coef(self.model.predict(image).argmax(axis=-1), 
-			gt)
+		prediction = self.model.predict(image).argmax(axis=-1)
+		adverserial_prediction = self.model.predict(adverserial_image).argmax(axis=-1)
+		dice_whole, adverserial_dice_whole = batch_dice(gt, np.concatenate([prediction, adverserial_prediction]), 
+								{'whole': (1, 2, 3)})[:, 0]
+
+		delta_dice_perc = (dice_whole - adverserial_dice_whole)*100/dice_whole
 
 		# print("perc. change in image:{}, perc. change in dice:{}, Sensitivity:{}".format(delta_image_perc,
 		# delta_dice_perc, delta_dice_perc/delta_image_perc))
@@ -178,14 +184,14 @@ class intervention():
 			# plt.xticks([])
 			# plt.yticks([])
 			plt.subplot(1,4,3)
-			plt.title("Old Seg, Dice = {}".format("{0:.2f}".format(dice_whole_coef(self.model.predict(image).argmax(axis=-1), gt))))
-			plt.imshow(np.argmax(self.model.predict(image), axis = -1).reshape((imshape, imshape)), vmin = 0, vmax=3)
+			plt.title("Old Seg, Dice = {}".format("{0:.2f}".format(dice_whole)))
+			plt.imshow(prediction.reshape((imshape, imshape)), vmin = 0, vmax=3)
 			plt.xticks([])
 			plt.yticks([])
 			plt.subplot(1,4,4)
-			plt.title("New Seg, Dice={}, Sensitivity={}".format("{0:.2f}".format(dice_whole_coef(self.model.predict(adverserial_image).argmax(axis=-1), 
-				gt)), "{0:.2f}".format(delta_dice_perc/delta_image_perc)))
-			plt.imshow(np.argmax(self.model.predict(adverserial_image), axis = -1).reshape((imshape, imshape)), vmin = 0, vmax=3)
+			plt.title("New Seg, Dice={}, Sensitivity={}".format("{0:.2f}".format(adverserial_dice_whole), 
+				"{0:.2f}".format(delta_dice_perc/delta_image_perc)))
+			plt.imshow(adverserial_prediction.reshape((imshape, imshape)), vmin = 0, vmax=3)
 			plt.xticks([])
 			plt.yticks([])
 			plt.tight_layout(pad=0)
@@ -5,7 +5,7 @@ import numpy as np
 import tensorflow as tf
 import os
 from matplotlib import pyplot as plt
-from scipy.cluster.hierarchy import dendrogram
+from scipy.cluster.hierarchy import dendrogram, fcluster
 from sklearn.cluster import AgglomerativeClustering
 from sklearn.metrics import silhouette_score, silhouette_samples
 
@@ -40,34 +40,36 @@ class Cluster():
 
     def _get_distances_(self, X, model, mode='l2'):
         """
+        distance and size of every merge in model.children_
+
+        centroids of merged clusters are written in place into a
+        preallocated (2n - 1) x d buffer, distances and sizes of all
+        the clusters are kept in arrays indexed by cluster id
+
+        X    : (n x d) clustered features
+        model: fitted AgglomerativeClustering
+        mode : how a merge is scaled by distances of its children,
+                'l2', 'max', 'cosine' or 'actual'
         """
-        distances = []
-        weights = []
-        children=model.children_
-
-        dims = (X.shape[1],1)
-        distCache = {}
-        weightCache = {}
-        for childs in children:
-            c1 = X[childs[0]].reshape(dims)
-            c2 = X[childs[1]].reshape(dims)
-            c1Dist = 0
-            c1W = 1
-            c2Dist = 0
-            c2W = 1
-            if childs[0] in distCache.keys():
-                c1Dist = distCache[childs[0]]
-                c1W = weightCache[childs[0]]
-            if childs[1] in distCache.keys():
-                c2Dist = distCache[childs[1]]
-                c2W = weightCache[childs[1]]
-            d = np.linalg.norm(c1-c2)
-            # d = np.squeeze(np.dot(c1.T, c2)/ (np.linalg.norm(c1)*np.linalg.norm(c2)))
-            cc = ((c1W*c1)+(c2W*c2))/(c1W+c2W)
+        children = model.children_
+        nsamples, nmerges = X.shape[0], len(children)
+
+        centroids = np.empty((nsamples + nmerges, X.shape[1]), dtype=np.float64)
+        centroids[:nsamples] = X
+        distCache   = np.zeros(nsamples + nmerges)
+        weightCache = np.ones(nsamples + nmerges)
 
-            X = np.vstack((X,cc.T))
+        for i, (child1, child2) in enumerate(children):
+            c1 = centroids[child1]
+            c2 = centroids[child2]
+            c1Dist, c1W = distCache[child1], weightCache[child1]
+            c2Dist, c2W = distCache[child2], weightCache[child2]
 
-            newChild_id = X.shape[0]-1
+            d = np.linalg.norm(c1-c2)
+            # d = np.squeeze(np.dot(c1.T, c2)/ (np.linalg.norm(c1)*np.linalg.norm(c2)))
+            newChild_id = nsamples + i
+            np.multiply(c1, c1W/(c1W+c2W), out=centroids[newChild_id])
+            centroids[newChild_id] += (c2W/(c1W+c2W))*c2
 
             # How to deal with a higher level cluster merge with lower distance:
             if mode=='l2':  # Increase the higher level cluster size suing an l2 norm
@@ -80,17 +82,23 @@ class Cluster():
             elif mode == 'actual':  # Plot the actual distance.
                 dNew = d
 
-            wNew = (c1W + c2W)
-            distCache[newChild_id] = dNew
-            weightCache[newChild_id] = wNew
+            distCache[newChild_id]   = dNew
+            weightCache[newChild_id] = c1W + c2W
 
-            distances.append(dNew)
-            weights.append(wNew)
-        return distances, weights
+        return distCache[nsamples:], weightCache[nsamples:]
 
 
     def _plot_dendrogram_(self, X, model, threshold=.7):
         """
+        linkage matrix of model and labels of the selected cut
+
+        model is fitted once with the full tree, number of clusters
+        is selected from the dendrogram and labels are obtained by
+        cutting the same linkage matrix, without refitting
+
+        X        : (n x d) clustered features
+        model    : AgglomerativeClustering fitted with compute_full_tree
+        threshold: fraction of max distance to cluster
         """
 
         # Create linkage matrix and then plot the dendrogram
@@ -105,10 +113,9 @@ class Cluster():
         level     = np.log((-.5*splitnode)/(1.*X.shape[0]) + 1.)/np.log(.5)
         nclusters = int(np.round((1.*X.shape[0])/(2.**level))) - 1
         
-        model = AgglomerativeClustering(n_clusters=max(2, nclusters)).fit(X)
-        distance, weight = self._get_distances_(X, model)
-        linkage_matrix = np.column_stack([model.children_, distance, weight]).astype(float)
-        labels = model.labels_
+        # cut by merge order, same as refitting with n_clusters
+        merge_order = np.column_stack([model.children_, np.arange(len(distance)), weight]).astype(float)
+        labels = fcluster(merge_order, max(2, nclusters), criterion='maxclust') - 1
         
         sil = silhouette_score(X, labels, metric='euclidean')
         print ("[INFO: BioExp Clustering] Layer: {}, Nclusters: {}, Labels: {}, Freq. of each labels: {} Clustering Score: {}".format(self.layer, nclusters, np.unique(labels), [sum(labels == i) for i in np.unique(labels)], sil))
@@ -146,7 +153,7 @@ class Cluster():
         if position: X = X*distance
     
         X = X.reshape(-1, shape[-1]).T
-        model = AgglomerativeClustering().fit(X)
+        model = AgglomerativeClustering(compute_full_tree=True).fit(X)
         
         # plot the top three levels of the dendrogram
         linkage_matrix, labels = self._plot_dendrogram_(X, model, threshold = threshold)
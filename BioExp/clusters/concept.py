@@ -15,6 +15,7 @@ from glob import glob
 import SimpleITK as sitk
 import pandas as pd
 from ..helpers.utils import *
+from ..helpers.extractor import FeatureExtractor
 from ..spatial.dissection import Dissector
 from ..spatial.flow import singlelayercam, cam
 from keras.models import Model
@@ -36,9 +37,12 @@ class ConceptIdentification():
 
         model      : keras model initialized with trained weights
         layer_name : intermediate layer name which needs to be analysed
+        layer_names: layers of all the concepts to be identified, if given
+                        activations of these layers are extracted 
+                        together in a single pass over dataset
     """
 
-    def __init__(self, model, weights_pth, metric= None, nclasses=4):
+    def __init__(self, model, weights_pth, metric= None, nclasses=4, layer_names=None):
 
         self.model       = model
         self.metric      = metric
@@ -46,6 +50,10 @@ class ConceptIdentification():
         self.nclasses    = nclasses
         self.model.load_weights(self.weights, by_name = True)
 
+        self.extractor   = None
+        if layer_names:
+            self.extractor = FeatureExtractor(self.model, layer_names)
+
 
     def _get_layer_idx(self, layer_name):
         """
@@ -109,7 +117,10 @@ class ConceptIdentification():
             img_ROI:
         """
         layer_name = concept_info['layer_name']        
-        self.dissector  = Dissector(self.model, layer_name)
+        extractor = self.extractor
+        if extractor is not None and not layer_name in extractor.layer_names:
+            extractor = None
+        self.dissector  = Dissector(self.model, layer_name, extractor=extractor)
 
         threshold_maps  = self.dissector.get_threshold_maps(dataset_path, save_path, percentile = 85, loader=loader)
 
@@ -1,16 +1,27 @@
+import os
 import numpy as np
-import weakref
-from collections import defaultdict
-from similarity import computeDistance
+import heapq
+import hashlib
+import threading
+import multiprocessing
 from time import time
 import math
 from pathlib import Path
 import pickle
 import pprint
 from matplotlib import pyplot as plt
-from scipy.cluster.hierarchy import dendrogram
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from scipy.cluster.hierarchy import dendrogram, fcluster
+from scipy.spatial.distance import pdist, squareform
 import sys
 
+try:
+    # sequence distance, only needed for clustering DNA sequences
+    from similarity import computeDistance
+except ImportError:
+    computeDistance = None
+
 # Pretty Printer Object for printing with indenting
 pp = pprint.PrettyPrinter(indent = 4)
 
@@ -27,31 +38,26 @@ class _UnionTracker_:
         '''Create a Union Entry in the linkage Matrix'''
         self.linkage_matrix[iteration][0] = A
         self.linkage_matrix[iteration][1] = B
-        self.linkage_matrix[iteration][2] = dist*UnionTracker.factor
+        self.linkage_matrix[iteration][2] = dist*_UnionTracker_.factor
         self.linkage_matrix[iteration][3] = pts
 
 class _HC_:
-    ''' Cluster class for creating and maintaining the clusters for the heirarchical clustering'''
-    ClusterCount = 0
-    _instances = defaultdict()
-    maxClusters = 0
+    ''' Cluster class for creating and maintaining the clusters for the heirarchical clustering,
+        every cluster belongs to a ClusteringSession '''
 
-    def __init__(self, key=None, seq=None):
+    def __init__(self, session, key=None, seq=None):
         ''' Initialization of clusters '''
-        self._id = Cluster.ClusterCount
+        self.session = session
+        self._id = session.clusterCount
         self.initID = self._id
-        Cluster.ClusterCount+=1
-        Cluster.maxClusters += 1
+        session.clusterCount += 1
+        session.maxClusters += 1
         self.clusterMembers = dict()
-        self._instances[self.initID] = weakref.ref(self)
+        session.clusters[self.initID] = self
         self.factor = 1
         if key is not None:
             self.addMember(key, seq)
 
-    def __del__(self):
-        ''' Destructor for the Cluster Object'''
-        Cluster._instances.pop(self.initID, None)
-
     def incrementFactor(self, factor=1):
         ''' Increment Multiplication Factor'''
         self.factor += factor
@@ -61,12 +67,12 @@ class _HC_:
         self.clusterMembers[key] = seq
 
     def destroy(self):
-        ''' Explcit destructor call '''
-        self.__del__()
+        ''' Explcit destructor call, removes the cluster from its session '''
+        self.session.clusters.pop(self.initID, None)
 
     def updateID(self, iteration):
         ''' Update the id of the cluster after merge operation to n+i where i is the iteration number'''
-        self._id = Cluster.maxClusters + iteration
+        self._id = self.session.maxClusters + iteration
 
     @property
     def memberCount(self):
@@ -78,85 +84,117 @@ class _HC_:
         ''' Returns the Member DNA sequences in the cluster '''
         return [self.clusterMembers[key] for key in self.clusterMembers.keys()]
 
-    @classmethod
-    def getClusterById(cls, clusterID):
-        ''' Fetch cluster object by referencing its id from the Cluster weak reference storage '''
-        ref = cls._instances[clusterID]
-        obj = ref()
-        return obj
 
+class ClusteringSession:
+    ''' State of a single heirarchical clustering run: clusters, distance matrix and counters.
 
-    @classmethod
-    def generateInitialDistanceMatrix(cls, data=None, test = False):
-        ''' Generate the initial nxn distance matrix by computing Distance between each DNA sequence '''
+        Nothing is shared among sessions, so several sessions (for example one per layer)
+        can run at the same time in threads or processes. Initial distance matrices are 
+        cached in cache_dir under the hash of the clustered data, so a cached matrix is 
+        only reused for identical data.
 
-        # For Testing Purpose
-        if test == True:
-            cls.simMatrix = np.array([[0,9,3,6,11],[9,0,7,5,10],[3,7,0,9,2],[6,5,9,0,8],[11,10,2,8,0]], dtype=float)
-        # Actual Dataset Implementation
-        else:
-            pickleFilePath = Path('data/simMat_3.pkl')
-            if pickleFilePath.exists():
-                # Load Pickle File storing the simMatrix
-                with open(pickleFilePath, 'rb') as file:
-                    cls.simMatrix = pickle.load(file)
-            else:
-                # Compute Distance among DNA Sequence
-                cls.simMatrix = np.ones((cls.ClusterCount, cls.ClusterCount))
-                for cID in range(cls.ClusterCount):
-                    clusterA = cls.getClusterById(cID)
-                    for _cID in range(cID, cls.ClusterCount):
-                        clusterB = cls.getClusterById(_cID)
-                        seq1 = clusterA.sequences[0]
-                        seq2 = clusterB.sequences[0]
-                        similarity_1 = computeDistance(seq1, seq2)
-                        cls.simMatrix[cID, _cID] = similarity_1
-                        cls.simMatrix[_cID, cID] = similarity_1
-                        print("similarity between {} and {} = {}\r".format(cID, _cID, similarity_1), end='', flush=True)
-                        sys.stdout.flush()
-                    print('')
-                # Save The Pickle File
-                with open(pickleFilePath, 'wb') as file:
-                    pickle.dump(cls.simMatrix, file)
-            # Normalize the Matrix
-            # minval = np.amin(cls.simMatrix, axis=(0,1))
-            # maxval = np.amax(cls.simMatrix, axis=(0,1))
-            # cls.simMatrix = ((cls.simMatrix-minval)/(maxval-minval))
-
-    @classmethod
-    def getClusters(cls):
-        for key in cls._instances.keys():
-            ref = cls._instances[key]
-            obj = ref()
-            if obj is not None:
-                yield obj
-            else:
-                cls._instances.pop(key, None)
+        cache_dir : directory for cached distance matrices, no caching if None
+    '''
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.clusters = dict()
+        self.clusterCount = 0
+        self.maxClusters = 0
+        self.simMatrix = None
+
+    def addCluster(self, key=None, seq=None):
+        ''' Create a new cluster in this session '''
+        return _HC_(self, key, seq)
+
+    def getClusterById(self, clusterID):
+        ''' Fetch cluster object by referencing its initial id '''
+        return self.clusters[clusterID]
 
+    def getClusters(self):
+        for key in list(self.clusters.keys()):
+            yield self.clusters[key]
 
-    @classmethod
-    def currentClusterCount(cls):
+    def currentClusterCount(self):
         ''' Returns the currently  existent clusters'''
-        return len(cls._instances.keys())
-
-
-    # Class method to find the minimum distance cluster pair
-    @classmethod
-    def findMinDistance(cls):
-        ''' Find the clusters most similar to each other i.e. with the least distance among them '''
-        minDistance = 1*math.inf
-        clusterA = None
-        clusterB = None
-        for rowNumber in range(0,cls.simMatrix.shape[0]-1):
-            for colNumber in range(rowNumber+1, cls.simMatrix.shape[1]):
-                if cls.simMatrix[rowNumber, colNumber] < minDistance:
-                    minDistance = cls.simMatrix[rowNumber, colNumber]
-                    clusterA = rowNumber
-                    clusterB = colNumber
-        return clusterA, clusterB, minDistance
-
-    @classmethod
-    def mergeSimilarClusters(cls, mergedRC, toDelete, iteration, dist, heuristic = 'Centroid'):
+        return len(self.clusters.keys())
+
+    def _cache_path_(self, kind, content):
+        ''' Path of the cached distance matrix of given content, None if caching is disabled '''
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(kind.encode() + content).hexdigest()
+        return os.path.join(self.cache_dir, 'simMat_{}.pkl'.format(digest))
+
+    def _load_cache_(self, path):
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    def _save_cache_(self, path, simMatrix):
+        if path is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # written under a unique name and renamed, concurrent sessions never read a partial file
+        tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmpPath, 'wb') as file:
+            pickle.dump(simMatrix, file)
+        os.replace(tmpPath, path)
+
+    def generateInitialDistanceMatrix(self, data=None, test = False):
+        ''' Generate the initial nxn distance matrix by computing Distance between each DNA sequence
+            of the session clusters, or euclidean distance between each row if data is a (n x d) 
+            numeric array '''
+
+        # For Testing Purpose
+        if test == True:
+            self.simMatrix = np.array([[0,9,3,6,11],[9,0,7,5,10],[3,7,0,9,2],[6,5,9,0,8],[11,10,2,8,0]], dtype=float)
+            return self.simMatrix
+
+        # Feature vectors, all the pairs at once
+        if data is not None:
+            data = np.ascontiguousarray(data, dtype=float).reshape(len(data), -1)
+            cachePath = self._cache_path_('euclidean', str(data.shape).encode() + data.tobytes())
+            self.simMatrix = self._load_cache_(cachePath)
+            if self.simMatrix is None:
+                self.simMatrix = squareform(pdist(data))
+                self._save_cache_(cachePath, self.simMatrix)
+            return self.simMatrix
+
+        # Actual Dataset Implementation
+        sequences = [self.getClusterById(cID).sequences[0] for cID in range(self.clusterCount)]
+        cachePath = self._cache_path_('sequence', pickle.dumps(sequences))
+        self.simMatrix = self._load_cache_(cachePath)
+        if self.simMatrix is None:
+            # Compute Distance among DNA Sequence
+            self.simMatrix = np.ones((self.clusterCount, self.clusterCount))
+            for cID in range(self.clusterCount):
+                for _cID in range(cID, self.clusterCount):
+                    similarity_1 = computeDistance(sequences[cID], sequences[_cID])
+                    self.simMatrix[cID, _cID] = similarity_1
+                    self.simMatrix[_cID, cID] = similarity_1
+                    print("similarity between {} and {} = {}\r".format(cID, _cID, similarity_1), end='', flush=True)
+                    sys.stdout.flush()
+                print('')
+            self._save_cache_(cachePath, self.simMatrix)
+        # Normalize the Matrix
+        # minval = np.amin(self.simMatrix, axis=(0,1))
+        # maxval = np.amax(self.simMatrix, axis=(0,1))
+        # self.simMatrix = ((self.simMatrix-minval)/(maxval-minval))
+        return self.simMatrix
+
+    def findMinDistance(self):
+        ''' Find the clusters most similar to each other i.e. with the least distance among them,
+            first pair in row major order of the upper triangle on ties '''
+        upper = np.where(np.triu(np.ones(self.simMatrix.shape, dtype=bool), 1), self.simMatrix, math.inf)
+        minIdx = np.argmin(upper)
+        if not upper.flat[minIdx] < math.inf:
+            return None, None, math.inf
+        clusterA, clusterB = np.unravel_index(minIdx, upper.shape)
+        return clusterA, clusterB, upper.flat[minIdx]
+
+    def mergeSimilarClusters(self, mergedRC, toDelete, iteration, dist, heuristic = 'Centroid'):
         ''' Cluster merging and new CLuster Creation based on the preset Heuristic 
             Available Heuristic Values are,
                 - Centroid
@@ -166,28 +204,19 @@ class _HC_:
         outdated_m = mergedRC
         outdated_d = toDelete
         
-        delCluster = cls.getClusterById(outdated_d)
+        delCluster = self.getClusterById(outdated_d)
         toDelete = delCluster._id
-        mergedCluster = cls.getClusterById(outdated_m)
+        mergedCluster = self.getClusterById(outdated_m)
         mergedRC = mergedCluster._id
 
-        d_mem = delCluster.memberCount
-        m_mem = mergedCluster.memberCount
-
-        if heuristic == 'Centroid': #Compute using Centroid Calculation
-            rowSum = (cls.simMatrix[outdated_m, :]*m_mem + cls.simMatrix[outdated_d, :]*d_mem)/(m_mem+d_mem)
-        elif heuristic == 'Max':    #Compute using Max Calculation
-            rowStack = np.vstack((cls.simMatrix[outdated_m, :], cls.simMatrix[outdated_d, :]))
-            rowSum = np.amax(rowStack, axis=0)
-        elif heuristic == 'Min':    #Compute using Min Calculation
-            rowStack = np.vstack((cls.simMatrix[outdated_m, :], cls.simMatrix[outdated_d, :]))
-            rowSum = np.amin(rowStack, axis=0)
+        rowSum = _update_row_(self.simMatrix, outdated_m, outdated_d, 
+                                mergedCluster.memberCount, delCluster.memberCount, heuristic)
 
         #Update the new row
-        cls.simMatrix[:, outdated_m] = rowSum
-        cls.simMatrix[outdated_m, :] = rowSum
-        cls.simMatrix[:, outdated_d] = 1*math.inf
-        cls.simMatrix[outdated_d, :] = 1*math.inf
+        self.simMatrix[:, outdated_m] = rowSum
+        self.simMatrix[outdated_m, :] = rowSum
+        self.simMatrix[:, outdated_d] = 1*math.inf
+        self.simMatrix[outdated_d, :] = 1*math.inf
 
         #Merge Data Points into the cluster
         for key in delCluster.clusterMembers.keys():
@@ -200,27 +229,177 @@ class _HC_:
         delCluster.destroy()
         return mergedRC, toDelete, mergedCluster.memberCount, mergedCluster.factor
 
+    def agglomerate(self, heuristic = 'Centroid', verbose = False):
+        ''' Heirarchical clustering of the session distance matrix with the priority queue engine,
+            returns the _UnionTracker_ '''
+        return agglomerate(self.simMatrix, heuristic = heuristic, verbose = verbose)
+
+
+def _update_row_(simMatrix, mergedRC, toDelete, m_mem, d_mem, heuristic):
+    ''' Distance of the merged cluster to every cluster, same rule as ClusteringSession.mergeSimilarClusters '''
+    if heuristic == 'Centroid': #Compute using Centroid Calculation
+        return (simMatrix[mergedRC, :]*m_mem + simMatrix[toDelete, :]*d_mem)/(m_mem+d_mem)
+    elif heuristic == 'Max':    #Compute using Max Calculation
+        return np.maximum(simMatrix[mergedRC, :], simMatrix[toDelete, :])
+    elif heuristic == 'Min':    #Compute using Min Calculation
+        return np.minimum(simMatrix[mergedRC, :], simMatrix[toDelete, :])
+    raise ValueError("Unknown heuristic {}, expected one of Centroid, Max, Min".format(heuristic))
+
+
+def agglomerate(simMatrix, heuristic = 'Centroid', verbose = False):
+    ''' Heirarchical clustering of a (n x n) distance matrix, returns the _UnionTracker_
+
+        Priority queue engine, produces the same linkage matrix as repeating 
+        ClusteringSession.findMinDistance and mergeSimilarClusters. Nearest neighbour 
+        (among the later rows) of every row is cached and kept in a heap, 
+        stale heap entries are skipped lazily. After a merge only the merged 
+        row, rows whose nearest neighbour was merged and rows for which the 
+        merged cluster became nearer are updated, each with one vectorized 
+        row operation, instead of scanning the whole matrix.
+
+        Available Heuristic Values are,
+            - Centroid
+            - Max
+            - Min
+    '''
+    simMatrix = np.array(simMatrix, dtype=float)
+    n = simMatrix.shape[0]
+    Uni = _UnionTracker_(n)
+
+    rows    = np.arange(n)
+    upper   = rows[None, :] > rows[:, None]
+    alive   = np.ones(n, dtype=bool)
+    members = np.ones(n, dtype=np.int64)
+    ids     = np.arange(n)
+
+    def nearest(idxs):
+        candidates = np.where(upper[idxs], simMatrix[idxs], math.inf)
+        nn = np.argmin(candidates, axis = 1)
+        return nn, candidates[np.arange(len(idxs)), nn]
+
+    nnIdx, nnDist = nearest(rows)
+    heap = [(nnDist[i], i, nnIdx[i]) for i in rows if nnDist[i] < math.inf]
+    heapq.heapify(heap)
+
+    for iteration in range(n-1):
+        # smallest distance, then smallest row, then smallest column
+        while len(heap):
+            dist, mergedRC, toDelete = heapq.heappop(heap)
+            if alive[mergedRC] and nnIdx[mergedRC] == toDelete and nnDist[mergedRC] == dist:
+                break
+        else:
+            raise ValueError("No finite distance left after {} merges".format(iteration))
+
+        rowSum = _update_row_(simMatrix, mergedRC, toDelete, members[mergedRC], members[toDelete], heuristic)
+        simMatrix[:, mergedRC] = rowSum
+        simMatrix[mergedRC, :] = rowSum
+        simMatrix[:, toDelete] = 1*math.inf
+        simMatrix[toDelete, :] = 1*math.inf
+
+        members[mergedRC] += members[toDelete]
+        Uni.union(ids[toDelete], ids[mergedRC], dist, members[mergedRC], iteration)
+        if verbose:
+            print('Union ({} - {}), distance {}'.format(ids[toDelete], ids[mergedRC], dist))
+        ids[mergedRC] = n + iteration
+        alive[toDelete] = False
+        nnDist[toDelete] = math.inf
+
+        # rows whose nearest neighbour changed or got farther
+        stale = alive & (rows < toDelete) & ((nnIdx == mergedRC) | (nnIdx == toDelete))
+        stale[mergedRC] = alive[mergedRC]
+        # rows for which merged cluster is now the nearest
+        closer = alive & (rows < mergedRC) & ~stale & ((rowSum < nnDist) | ((rowSum == nnDist) & (nnIdx > mergedRC)))
+
+        nnIdx[closer], nnDist[closer] = mergedRC, rowSum[closer]
+        staleIdx = np.nonzero(stale)[0]
+        if len(staleIdx):
+            nnIdx[staleIdx], nnDist[staleIdx] = nearest(staleIdx)
+
+        for i in np.concatenate([staleIdx, np.nonzero(closer)[0]]):
+            if nnDist[i] < math.inf:
+                heapq.heappush(heap, (nnDist[i], i, nnIdx[i]))
+
+    return Uni
+
+
+def cluster_weights(weights, threshold=0.5, heuristic='Centroid', cache_dir=None):
+    """
+    Clusters output filters of a convolution layer, in a fresh
+    ClusteringSession, so calls can run in parallel
+
+    weights   : (k x k x in_c x out_c) layer weights
+    threshold : fraction of max distance to cluster 
+    heuristic : Centroid, Max or Min
+    cache_dir : directory for cached distance matrices
+
+    returns linkage matrix and labels of each filter
+    """
+    shape = weights.shape
+    X = weights.reshape(-1, shape[-1]).T
+
+    position = np.linspace(0, X.shape[-1], X.shape[-1])
+    X = X + position[None, :]
+
+    session = ClusteringSession(cache_dir = cache_dir)
+    session.generateInitialDistanceMatrix(X)
+    linkage_matrix = session.agglomerate(heuristic = heuristic).linkage_matrix
+
+    labels = fcluster(linkage_matrix, threshold*np.max(linkage_matrix[:, 2]), criterion='distance') - 1
+    return linkage_matrix, labels
+
+
+def _worker_cluster_(args):
+    """
+    clusters a single layer in a worker process
+    """
+    layer_name, weights, threshold, heuristic, cache_dir = args
+    return layer_name, cluster_weights(weights, threshold, heuristic, cache_dir)
+
+
+def cluster_layers(model, layer_names, threshold=0.5, heuristic='Centroid', cache_dir=None, nworkers=1):
+    """
+    Clusters several layers of a model, one layer per worker process
+
+    model       : keras model loaded with weights
+    layer_names : names of convolution layers to cluster
+    nworkers    : number of worker processes
+
+    returns dict with layer name as key and (linkage matrix, labels) as value
+    """
+    jobs = [(layer_name, np.array(model.get_layer(layer_name).get_weights()[0]), 
+                threshold, heuristic, cache_dir) for layer_name in layer_names]
+
+    if nworkers > 1 and len(jobs) > 1:
+        # spawn, tensorflow sessions do not survive a fork
+        pool = multiprocessing.get_context('spawn').Pool(min(nworkers, len(jobs)))
+        try:
+            return dict(pool.map(_worker_cluster_, jobs))
+        finally:
+            pool.terminate()
+    return dict(map(_worker_cluster_, jobs))
+
+
 # Driver Function to execute the Heirarchical Clustering
-@timer
 def main():
     test = False
     heuristic = 'Centroid'
     reader = DataReader()
     data = reader.loadData()
     dataArray = reader.getDataArray()
+    session = ClusteringSession(cache_dir = 'data')
     if test == True:
-        clusters = [Cluster(dataPoint, data[dataPoint]) for dataPoint in list(data.keys())[:5]]     
+        clusters = [session.addCluster(dataPoint, data[dataPoint]) for dataPoint in list(data.keys())[:5]]     
     else:
-        clusters = [Cluster(dataPoint, data[dataPoint]) for dataPoint in list(data.keys())[:]]      
-    Cluster.generateInitialDistanceMatrix(test)
-    Uni = UnionTracker(len(clusters))
+        clusters = [session.addCluster(dataPoint, data[dataPoint]) for dataPoint in list(data.keys())[:]]      
+    session.generateInitialDistanceMatrix(test = test)
+    Uni = _UnionTracker_(len(clusters))
     print('')
     iteration = 0
-    while(Cluster.currentClusterCount() > 1):
-        clsA, clsB, dist = Cluster.findMinDistance()
+    while(session.currentClusterCount() > 1):
+        clsA, clsB, dist = session.findMinDistance()
         mergedRC = min(clsA, clsB)
         toDelete = max(clsA, clsB)
-        newIDm, newIDd, pts, factor = Cluster.mergeSimilarClusters(mergedRC, toDelete, iteration, dist, heuristic=heuristic)
+        newIDm, newIDd, pts, factor = session.mergeSimilarClusters(mergedRC, toDelete, iteration, dist, heuristic=heuristic)
         Uni.union(newIDd, newIDm, dist, pts, iteration)
         iteration += 1
 
@@ -240,7 +419,7 @@ if __name__ == "__main__":
 
 class Cluster(object):
     
-    def __init__(self, model, weights_pth, layer_name, max_clusters = None, heuristic = 'Centroid'):
+    def __init__(self, model, weights_pth, layer_name, max_clusters = None, heuristic = 'Centroid', cache_dir = None):
         
         """
         model       : keras model architecture (keras.models.Model)
@@ -249,6 +428,7 @@ class Cluster(object):
             layer_name  : name of the layer which needs to be ablated
             test_img    : test image used for ablation
             max_clusters: maximum number of clusters
+            cache_dir   : directory for cached distance matrices
         """     
 
         self.model = model
@@ -260,6 +440,7 @@ class Cluster(object):
                 self.layer_idx = idx
         self.weights = np.array(self.model.layers[self.layer_idx].get_weights())[0]
         self.heuristic = heuristic
+        self.cache_dir = cache_dir
         
     def drawDendrogram(self, UniObj, labels, heuristic):
         ''' Generate the dendrogram using te UniObject's linkage matrix '''
@@ -272,46 +453,33 @@ class Cluster(object):
 
     def get_clusters(self, threshold=0.5, save_path = None):
         """
-        Does clustering on feature space
+        Does clustering on feature space, holds no global state
+        and can run per layer in a thread or process pool
 
         save_path  : path to save dendrogram image
         threshold  : fraction of max distance to cluster 
         """
 
-        shape = self.weights.shape
-        X = self.weights.reshape(shape[-1], -1)
-
-        position = np.linspace(0, X.shape[-1], X.shape[-1])
-        X = X + position[None, :]
-
-        clusters = [_HC_(dataPoint, data[dataPoint]) for dataPoint in data]      
-        Cluster.generateInitialDistanceMatrix(test)
-        Uni = _UnionTracker_(len(clusters))
-
-        iteration = 0
-        while(Cluster.currentClusterCount() > 1):
-            clsA, clsB, dist = Cluster.findMinDistance()
-            mergedRC = min(clsA, clsB)
-            toDelete = max(clsA, clsB)
-            newIDm, newIDd, pts, factor = Cluster.mergeSimilarClusters(mergedRC, 
-                                                                    toDelete, 
-                                                                    iteration, 
-                                                                    dist, 
-                                                                    heuristic=self.heuristic)
-            Uni.union(newIDd, newIDm, dist, pts, iteration)
-            iteration += 1
-
-        self.drawDendrogram(Uni, labels, heuristic)
-        
-        plt.figure(figsize=(20, 10))
-        plt.title('Hierarchical Clustering Dendrogram')
-        R = dendrogram(linkage_matrix, truncate_mode='level')
-        plt.xlabel("Number of points in node (or index of point if no parenthesis).")
+        linkage_matrix, labels = cluster_weights(self.weights, 
+                                                threshold = threshold, 
+                                                heuristic = self.heuristic, 
+                                                cache_dir = self.cache_dir)
 
         if save_path:
+            # figure not registered with pyplot, safe to draw from several threads
+            fig = Figure(figsize=(20, 10))
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot(111)
+            ax.set_title('Hierarchical Clustering Dendrogram - ' + self.heuristic)
+            R = dendrogram(linkage_matrix, truncate_mode='level', ax=ax)
+            ax.set_xlabel("Number of points in node (or index of point if no parenthesis).")
             os.makedirs(save_path, exist_ok=True)
-            plt.savefig(os.path.join(save_path, '{}_dendrogram.png'.format(self.layer)), bbox_inches='tight')
+            fig.savefig(os.path.join(save_path, '{}_dendrogram.png'.format(self.layer)), bbox_inches='tight')
         else:
+            plt.figure(figsize=(20, 10))
+            plt.title('Hierarchical Clustering Dendrogram - ' + self.heuristic)
+            R = dendrogram(linkage_matrix, truncate_mode='level')
+            plt.xlabel("Number of points in node (or index of point if no parenthesis).")
             plt.show()
 
         return labels 
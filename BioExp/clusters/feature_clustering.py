@@ -4,9 +4,9 @@ import keras
 import numpy as np
 import tensorflow as tf
 import os, pickle
+import multiprocessing
 import SimpleITK as sitk
 from radiomics.shape2D import RadiomicsShape2D
-from radiomics.firstorder import RadiomicsFirstOrder
 from radiomics.glcm import RadiomicsGLCM
 from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
@@ -22,13 +22,109 @@ from sklearn.decomposition import PCA
 from sklearn.cluster import AgglomerativeClustering
 
 
+# first order features computed by RadiomicsFirstOrder.enableAllFeatures, in its order
+FIRST_ORDER_FEATURES = ['10Percentile', '90Percentile', 'Energy', 'Entropy', 'InterquartileRange', 
+                        'Kurtosis', 'Maximum', 'Mean', 'MeanAbsoluteDeviation', 'Median', 'Minimum', 
+                        'Range', 'RobustMeanAbsoluteDeviation', 'RootMeanSquared', 'Skewness', 
+                        'TotalEnergy', 'Uniformity', 'Variance']
+
+RADIOMICS_CLASSES = {'orientation': RadiomicsShape2D,
+                     'texture': RadiomicsGLCM}
+
+
+def first_order_features(x, bin_width = 25, voxel_shift = 0):
+    """
+    PyRadiomics first order statistics of many images at once,
+    with the whole image as mask and unit pixel spacing
+
+    x          : (... x nvoxels) array, one image per row
+    bin_width  : bin width of discretization for Entropy and Uniformity
+    voxel_shift: shift added to intensities for energy features
+
+    returns (... x len(FIRST_ORDER_FEATURES)) array
+    """
+    x = np.asarray(x, dtype=np.float64)
+    shape = x.shape[:-1]
+    x = x.reshape(-1, x.shape[-1])
+    nvoxels = x.shape[-1]
+
+    p10, p25, median, p75, p90 = np.percentile(x, [10, 25, 50, 75, 90], axis=-1)
+    minimum, maximum = np.min(x, axis=-1), np.max(x, axis=-1)
+    mean = np.mean(x, axis=-1)
+
+    centered = x - mean[:, None]
+    m2 = np.mean(centered**2, axis=-1)
+    m3 = np.mean(centered**3, axis=-1)
+    m4 = np.mean(centered**4, axis=-1)
+    # Flat Region, prevent division by 0 errors
+    flat = m2 == 0
+    m3[flat], m4[flat] = 0, 0
+    safe_m2 = np.where(flat, 1., m2)
+
+    energy = np.sum((x + voxel_shift)**2, axis=-1)
+
+    robust = (x >= p10[:, None]) & (x <= p90[:, None])
+    robust_mean = np.sum(x*robust, axis=-1)/np.sum(robust, axis=-1)
+    robust_mad  = np.sum(np.abs(x - robust_mean[:, None])*robust, axis=-1)/np.sum(robust, axis=-1)
+
+    # fixed bin width discretization, bins start at a multiple of bin_width
+    low  = minimum - np.mod(minimum, bin_width)
+    bins = np.floor((x - low[:, None])/bin_width).astype(np.int64)
+    nbins = int(np.max(bins)) + 1
+    counts = np.bincount((bins + nbins*np.arange(len(x))[:, None]).ravel(), 
+                            minlength = nbins*len(x)).reshape(len(x), nbins)
+    prob = counts/(1.*nvoxels)
+
+    features = np.stack([p10, p90, energy, 
+                        -np.sum(prob*np.log2(prob + np.spacing(1)), axis=-1),
+                        p75 - p25, 
+                        m4/safe_m2**2.,
+                        maximum, mean, 
+                        np.mean(np.abs(centered), axis=-1),
+                        median, minimum, maximum - minimum, robust_mad,
+                        np.sqrt(energy/nvoxels),
+                        m3/safe_m2**1.5,
+                        energy,
+                        np.sum(prob**2, axis=-1),
+                        m2], axis=-1)
+    return features.reshape(shape + (len(FIRST_ORDER_FEATURES),))
+
+
+def _extract_features_(x, mask, function):
+    imr = sitk.GetImageFromArray
+    try:
+        features = function(imr(x), imr(mask))
+        features.enableAllFeatures()
+        features.execute()
+        return np.array(list(features.featureValues.values()))
+    except:
+        return 0
+
+
+def _radiomics_features_(args):
+    """
+    PyRadiomics features of a filter averaged over input channels,
+    runs in a worker process
+
+    args: (k x k x in_c filter, 'orientation' or 'texture')
+    """
+    x, kind = args
+    function = RADIOMICS_CLASSES[kind]
+    feature = _extract_features_(x[:,:,0], np.ones_like(x[:,:,0]), function)
+    for wt in range(1, x.shape[-1]):
+        feature += _extract_features_(x[:,:,wt], np.ones_like(x[:,:,wt]), function)
+    feature /= x.shape[-1]
+    return feature
+
+
 class Cluster():
     """
     A class for conducting an cluster study on a trained keras model instance
     """     
 
 
-    def __init__(self, model, weights_pth, layer_name, max_clusters = None, method = None):
+    def __init__(self, model, weights_pth, layer_name, max_clusters = None, method = None, 
+                    radiomics = (), nworkers = 1):
         
         """
         model       : keras model architecture (keras.models.Model)
@@ -37,6 +133,9 @@ class Cluster():
                 layer_name  : name of the layer which needs to be ablated
                 test_img    : test image used for ablation
                 max_clusters: maximum number of clusters
+                radiomics   : PyRadiomics features used along with first order 
+                                statistics, subset of ('orientation', 'texture')
+                nworkers    : number of processes for PyRadiomics features
         """     
 
         self.model = model
@@ -44,6 +143,8 @@ class Cluster():
         self.layer_name = layer_name
         self.max_clusters = max_clusters
         self.method = method
+        self.radiomics = radiomics
+        self.nworkers = nworkers
         self.layer_idx = 0
         for idx, layer in enumerate(self.model.layers):
             if layer.name == self.layer_name:
@@ -61,66 +162,58 @@ class Cluster():
 
 
     def extract_features(self, x, mask, function):
-        imr = sitk.GetImageFromArray
-        try:
-            features = function(imr(x), imr(mask))
-            features.enableAllFeatures()
-            features.execute()
-            return np.array(list(features.featureValues.values()))
-        except:
-            return 0
+        return _extract_features_(x, mask, function)
 
 
     def orientation_features(self, x):
         """
         x: dim k x k x in_c
         """
-        feature = self.extract_features(x[:,:,0], np.ones_like(x[:,:,0]), RadiomicsShape2D)
-        for wt in range(1, x.shape[-1]):
-            feature += self.extract_features(x[:,:,wt], np.ones_like(x[:,:,wt]), RadiomicsShape2D)
-        feature /= x.shape[-1]
-        return feature
+        return _radiomics_features_((x, 'orientation'))
 
 
     def statistical_features(self, x):
         """
-
+        x: dim k x k x in_c
         """
-        feature = self.extract_features(x[:,:,0], np.ones_like(x[:,:,0]), RadiomicsFirstOrder)
-        for wt in range(1, x.shape[-1]):
-            feature += self.extract_features(x[:,:,wt], np.ones_like(x[:,:,wt]), RadiomicsFirstOrder)
-        feature /= x.shape[-1]
-        return feature
+        return np.mean(first_order_features(x.reshape(-1, x.shape[-1]).T), axis=0)
 
 
     def other_features(self, x):
         """
-
+        x: dim k x k x in_c
         """
-        feature = self.extract_features(x[:,:,0], np.ones_like(x[:,:,0]), RadiomicsGLCM)
-        for wt in range(1, x.shape[-1]):
-            feature += self.extract_features(x[:,:,wt], np.ones_like(x[:,:,wt]), RadiomicsGLCM)
-        feature /= x.shape[-1]
-        return feature
+        return _radiomics_features_((x, 'texture'))
 
 
     def get_features(self, wts):
         """
         wts: shape(k, k, in_c, out_c)
 
+        first order statistics of every (filter, input channel) kernel
+        are computed at once in numpy, PyRadiomics features listed in 
+        self.radiomics are computed per filter in nworkers processes
         """
         wts = self.normalize(wts)
         nfeatures = wts.shape[-1]
-        features = []
-        for i in range(nfeatures):
-            feature = []
-            # feature.extend(self.orientation_features(wts[:, :, :, i]))
-            feature.extend(self.statistical_features(wts[:, :, :, i]))
-            # feature.extend(self.other_features(wts[:, :, :, i]))
-            features.append(feature)
-
-        features = np.array(features)
-        print ("[INFO: BioExp Clustering] Layer: {} Extracted feature dimension: {}".format(self.layer, features.shape))
+
+        # (out_c x in_c x k*k) kernels
+        kernels  = wts.reshape(-1, wts.shape[-2], nfeatures).transpose(2, 1, 0)
+        features = [np.mean(first_order_features(kernels), axis=1)]
+
+        for kind in self.radiomics:
+            jobs = [(wts[:, :, :, i], kind) for i in range(nfeatures)]
+            if self.nworkers > 1:
+                pool = multiprocessing.get_context('spawn').Pool(self.nworkers)
+                try:
+                    features.append(np.array(pool.map(_radiomics_features_, jobs)))
+                finally:
+                    pool.terminate()
+            else:
+                features.append(np.array([_radiomics_features_(job) for job in jobs]))
+
+        features = np.concatenate(features, axis=-1)
+        print ("[INFO: BioExp Clustering] Layer: {} Extracted feature dimension: {}".format(self.layer_name, features.shape))
         return features
 
 
@@ -130,7 +223,7 @@ class Cluster():
         """
         wts = self.normalize(wts)
         features = wts.reshape(-1, wts.shape[-1]).T
-        print ("[INFO: BioExp Clustering] Layer: {} Extracted features dimension: {}".format(self.layer, features.shape))
+        print ("[INFO: BioExp Clustering] Layer: {} Extracted features dimension: {}".format(self.layer_name, features.shape))
         return features
 
 
@@ -7,15 +7,20 @@ import os
 import pdb
 import cv2 
 import pickle
+import json
+import multiprocessing
 from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
 
 
 import pandas as pd
 from ..helpers.utils import *
+from ..helpers.sketch import JointHistogram
+from ..helpers.layersplit import LayerSplit, get_ablated_value
+from .sparse import SparseGraph
 from ..spatial.ablation import Ablate
 
-from keras.models import Model, clone_model
+from keras.models import Model, clone_model, model_from_json
 from keras.utils import np_utils
 from tqdm import tqdm
 from skimage.transform import resize as imresize
@@ -24,11 +29,37 @@ from scipy.ndimage.measurements import label
 from scipy.ndimage.morphology import (binary_dilation, 
                                     generate_binary_structure)
 from scipy.stats import chi2_contingency
+from scipy.special import digamma
 
 from pgm.helpers.common import Node
 from pgm.representation.LinkedListBN import Graph
 
 EPS = np.finfo(np.float32).eps
+MAX_CELLS = 2**24 # histogram cells / distances held in memory at once
+
+_worker_graph = None
+
+def _init_worker_(model_json, weights_pth, classinfo, custom_objects):
+    r"""
+    builds a private model instance in every worker process
+    """
+    global _worker_graph
+    model = model_from_json(model_json, custom_objects = custom_objects)
+    _worker_graph = CausalGraph(model, weights_pth, classinfo)
+
+
+def _worker_link_(args):
+    r"""
+    computes weight of a single edge in a worker process
+    """
+    nodei, nodej, nodei_info, nodej_info, dataset_path, loader, max_samples, bins = args
+    link_info = _worker_graph.get_link(nodei_info, nodej_info,
+                                        dataset_path = dataset_path,
+                                        loader = loader,
+                                        max_samples = max_samples,
+                                        bins = bins)
+    return nodei, nodej, link_info
+
 
 class CausalGraph():
     """
@@ -48,6 +79,7 @@ class CausalGraph():
         self.classinfo  = classinfo
         self.noutputs   = len(self.model.outputs)
         self.model.load_weights(self.weights)
+        self._splits    = {}
 
             
     def _get_layer_idx_(self, layer_name):
@@ -87,21 +119,130 @@ class CausalGraph():
         """
         c_normalized = c / float(np.sum(c))
         c_normalized = c_normalized[np.nonzero(c_normalized)]
-        H = -sum(c_normalized* np.log2(c_normalized))  
+        H = -np.sum(c_normalized* np.log2(c_normalized))  
+        return H + EPS
+
+
+    def _bin_range_(self, lo, hi):
+        r"""
+        histogram range of each column from its minimum and maximum,
+        same as np.histogram for constant columns
+        """
+        return np.where(lo == hi, lo - 0.5, lo), np.where(lo == hi, hi + 0.5, hi)
+
+
+    def _bin_indices_(self, x, bins, lo=None, hi=None):
+        r"""
+        histogram bin index of every value, bins span the range of
+        each column separately, same binning as np.histogram
+
+        x   : (N, D) array
+        bins: number of bins
+        lo  : lower end of range of each column (D,), range of x if None
+        hi  : upper end of range of each column (D,), values outside
+                of (lo, hi) fall in the outer bins
+        """
+        x  = x.astype(np.float64)
+        if lo is None:
+            lo, hi = self._bin_range_(x.min(axis=0), x.max(axis=0))
+
+        edges = np.linspace(lo, hi, bins + 1, axis=-1)
+        cols  = np.arange(x.shape[1])
+
+        idxs  = np.clip(((x - lo)*(bins/(hi - lo))).astype('int64'), 0, bins - 1)
+        # corrects floating point round off near bin edges
+        idxs -= x < edges[cols, idxs]
+        idxs += (x >= edges[cols, idxs + 1]) & (idxs < bins - 1)
+        return np.clip(idxs, 0, bins - 1)
+
+
+    def _batch_entropy_(self, keys, ncells):
+        r"""
+        shanan's entropy of every column, counts of all the columns
+        in a block are obtained with a single bincount over combined
+        bin indices
+
+        keys  : (N, D) bin index of each value, range [0, ncells)
+        ncells: number of bins per column
+        """
+        nsamples, ncols = keys.shape
+        H = np.zeros(ncols)
+
+        block = max(1, MAX_CELLS // ncells)
+        for st in range(0, ncols, block):
+            k = keys[:, st: st + block]
+            nb = k.shape[1]
+            counts = np.bincount((k + np.arange(nb)*ncells).ravel(), minlength = nb*ncells)
+            cells  = np.nonzero(counts)[0]
+            p = counts[cells]/float(nsamples)
+            H[st: st + nb] = np.bincount(cells // ncells, weights = -p*np.log2(p), minlength = nb)
         return H + EPS
+
+
+    def _histogram_MI_(self, x, y, bins):
+        r"""
+        normalized MI of every column, NMI = 2*I(X,Y)/(H(X) + H(Y)),
+        identical to _calc_MI_ applied column by column
+        """
+        bx = self._bin_indices_(x, bins)
+        by = self._bin_indices_(y, bins)
+
+        H_X  = self._batch_entropy_(bx, bins) 
+        H_Y  = self._batch_entropy_(by, bins) 
+        H_XY = self._batch_entropy_(bx*bins + by, bins*bins) 
+
+        return 2.*(H_X + H_Y - H_XY)/(H_X + H_Y)
+
+
+    def _ksg_MI_(self, x, y, k=3):
+        r"""
+        Kraskov-Stogbauer-Grassberger (k nearest neighbour) MI of every
+        column, normalized to [0, 1) as sqrt(1 - exp(-2I)) 
+
+        ties (for example zero activations) are broken by adding a
+        fixed tiny jitter, so estimates are deterministic
+        """
+        nsamples, ncols = x.shape
+        if nsamples <= k:
+            raise ValueError("KSG estimator needs more than k={} samples, {} were provided".format(k, nsamples))
+
+        rng = np.random.RandomState(0)
+        x = x.astype(np.float64) + 1e-10*rng.randn(*x.shape)
+        y = y.astype(np.float64) + 1e-10*rng.randn(*y.shape)
+
+        mi = np.zeros(ncols)
+        block = max(1, MAX_CELLS // nsamples**2)
+        for st in range(0, ncols, block):
+            bx, by = x[:, st: st + block], y[:, st: st + block]
+            dx = np.abs(bx[:, None] - bx[None])
+            dy = np.abs(by[:, None] - by[None])
+            dxy = np.maximum(dx, dy)
+            dxy[np.arange(nsamples), np.arange(nsamples)] = np.inf
+
+            eps = np.partition(dxy, k - 1, axis=1)[:, k - 1][:, None]
+            # counts include the sample itself, i.e. n + 1
+            nx = np.sum(dx < eps, axis=1)
+            ny = np.sum(dy < eps, axis=1)
+            mi[st: st + block] = digamma(k) + digamma(nsamples) - \
+                                    np.mean(digamma(nx) + digamma(ny), axis=0)
+
+        return np.sqrt(1. - np.exp(-2.*np.maximum(mi, 0)))
         
 
-    def MI(self, distA, distB, bins=100, random=0.10):
+    def MI(self, distA, distB, bins=100, random=None, estimator='histogram', k=3):
         r"""
         calculates mutual information between two 
-        given distribution
+        given distribution, all the vectors are estimated at once
         
         distA: tensor of any order, first axis should be sample axis (N, ...)
         distB: same dimensionality as distA
         bins : bins used in creating histograms
         random: to seep up computation by randomly selecting n vectors 
                 and considers expectation
-                (% information between (0, 1])
+                (% information between (0, 1]), all vectors if None
+        estimator: 'histogram' for normalized MI of binned values,
+                'ksg' for k nearest neighbour estimate
+        k    : number of neighbours for ksg estimator
         """
         
         assert distA.shape == distB.shape, \
@@ -111,21 +252,97 @@ class CausalGraph():
         x = distA.reshape(distA.shape[0], -1)
         y = distB.reshape(distB.shape[0], -1)
 
-        idxs = np.arange(x.shape[-1])
         if random:
-            idxs = np.random.choice(idxs, int(random*x.shape[-1]))
-
-        mi = []
-        for i in idxs:
-            mi.append(self._calc_MI_(x[:, i], y[:,i], bins))
+            idxs = np.random.choice(np.arange(x.shape[-1]), int(random*x.shape[-1]))
+            x, y = x[:, idxs], y[:, idxs]
+
+        if estimator == 'histogram':
+            mi = self._histogram_MI_(x, y, bins)
+        elif estimator == 'ksg':
+            mi = self._ksg_MI_(x, y, k = k)
+        else:
+            raise ValueError("Unknown estimator {}, should be one of 'histogram', 'ksg'".format(estimator))
         return np.mean(mi)
         
 
+    def _get_split_(self, nodeA_layer, nodeB_layer):
+        r"""
+        intervention model for a pair of layers, split at nodeA layer
+        and evaluated till nodeB layer; nodeA filters are intervened with
+        a channel mask, so the model is built once per layer pair and
+        reused by every link between them
+
+        returns split and value of an ablated nodeB channel, also
+        computed once per layer pair (evaluating it adds graph ops)
+        """
+        key = (nodeA_layer, nodeB_layer)
+        if not key in self._splits:
+            nodeB_layer = self.model.get_layer(nodeB_layer)
+            self._splits[key] = (LayerSplit(self.model, nodeA_layer, 
+                                    outputs = nodeB_layer.get_output_at(0)),
+                                 get_ablated_value(nodeB_layer))
+        return self._splits[key]
+
+
+    def _intervened_batches_(self, split, maskA, maskB, nodeB_value, 
+                                input_paths, dataset_path, loader, batch_size):
+        r"""
+        generator over (pre intervention, post intervention) activations
+        of nodeB layer (N x ncells x nchannels), batch by batch
+        """
+        for st in range(0, len(input_paths), batch_size):
+            inputs = np.array([loader(os.path.join(dataset_path, input_path))[0] 
+                                    for input_path in input_paths[st: st + batch_size]])
+            frontier = split.upstream(inputs, batch_size = batch_size)
+            pre_intervened = split.downstream(frontier, maskA, batch_size = batch_size)[0]
+            post_intervened = pre_intervened*maskB + nodeB_value*(1. - maskB)
+            yield (pre_intervened.reshape(len(inputs), -1, len(maskB)), 
+                    post_intervened.reshape(len(inputs), -1, len(maskB)))
+
+
+    def _calibrate_ranges_(self, batches, nsamples):
+        r"""
+        histogram range of every channel, (lo, hi) of pre and post 
+        intervention activations of first nsamples samples
+
+        batches: list of (pre, post) intervention activations 
+                    (N x ncells x nchannels)
+        """
+        ranges = []
+        for i in range(2):
+            values = np.concatenate([batch[i] for batch in batches])[:nsamples]
+            values = values.reshape(-1, values.shape[-1])
+            ranges.append(self._bin_range_(values.min(axis=0), values.max(axis=0)))
+        return ranges
+
+
+    def _update_histogram_(self, histogram, batches, ranges):
+        r"""
+        bins pre and post intervention activations of every channel in
+        given ranges and adds them to the joint histogram of the channel
+
+        batches: list of (pre, post) intervention activations 
+                    (N x ncells x nchannels)
+        ranges : ((lo, hi) of pre, (lo, hi) of post), scalars or one 
+                    value per channel
+        """
+        nchannels = histogram.ncolumns
+        (xlo, xhi), (ylo, yhi) = [[np.broadcast_to(np.asarray(v, dtype=np.float64), (nchannels,)) 
+                                        for v in rng] for rng in ranges]
+        for x, y in batches:
+            histogram.update(self._bin_indices_(x.reshape(-1, nchannels), histogram.bins, xlo, xhi), 
+                                self._bin_indices_(y.reshape(-1, nchannels), histogram.bins, ylo, yhi))
+
+
     def get_link(self, nodeA_info, 
                  nodeB_info, 
                  dataset_path, 
                  loader,
-                 max_samples = -1):
+                 max_samples = -1,
+                 batch_size = 8,
+                 bins = 100,
+                 ranges = None,
+                 calibration_samples = 8):
         r"""
         get link information between two nodes, nodeA, nodeB
         observation based on interventions
@@ -140,64 +357,191 @@ class CausalGraph():
                         simultaniously
         max_samples : maximum number of samples required for expectation
                          if -1 considers all images in provided root dir
+        batch_size  : number of images per forward pass
+        bins        : bins used in creating histograms
+        ranges      : ((lo, hi) of pre, (lo, hi) of post intervention
+                        activations), scalars or one value per nodeB filter;
+                        range of first calibration_samples samples if None,
+                        later values outside of it fall in the outer bins
+        calibration_samples: number of samples used for ranges, they are
+                        kept in memory till ranges are known, so no extra
+                        forward passes are needed
+
+        NMI is averaged over all the activations of nodeB layer (as in MI).
+        Activations of nodeB filters are binned batch by batch in a joint
+        histogram per filter, pooled over spatial positions, so memory is
+        nfilters x bins^2 counts. Activations of other channels are held 
+        at the ablated value by the intervention, their NMI is 1 if they
+        are constant before the intervention too and ~0 otherwise, only
+        their running range is kept. The result does not depend on 
+        batch_size.
         """
         
 
-        nodeA_idx   = self._get_layer_idx_(nodeA_info['layer_name'])
-        nodeA_idxs  = nodeA_info['filter_idxs']
-        nodeB_idx   = self._get_layer_idx_(nodeB_info['layer_name'])
-        nodeB_idxs  = nodeB_info['filter_idxs']
-        
-        total_filters = np.arange(np.array(self.model.layers[nodeA_idx].get_weights())[0].shape[-1])
-
-        modelT = clone_model(self.model)
-        modelP = clone_model(self.model)
-
-        modelT = Model(inputs = modelT.input, 
-                        outputs = modelT.get_layer(nodeB_info['layer_name']).output)
-        modelP = Model(inputs = modelP.input, 
-                        outputs = modelP.get_layer(nodeB_info['layer_name']).output)
+        split, nodeB_value = self._get_split_(nodeA_info['layer_name'], nodeB_info['layer_name'])
 
         #########################
-        test_filters  = np.delete(total_filters, nodeA_idxs)
-        layer_weights = np.array(modelT.layers[nodeA_idx].get_weights().copy())
-        occluded_weights = layer_weights.copy()
-        for j in test_filters:
-                occluded_weights[0][:,:,:,j] = 0
-                try: occluded_weights[1][j] = 0
-                except: pass
-        modelT.layers[nodeA_idx].set_weights(occluded_weights)
-        modelP.layers[nodeA_idx].set_weights(occluded_weights)
-
+        # do(C_p-i = 0): only nodeA filters are active
+        test_filters = np.delete(np.arange(split.nchannels), nodeA_info['filter_idxs'])
+        maskA = split.get_mask(test_filters)
 
         #########################
-        total_filters = np.arange(np.array(self.model.layers[nodeB_idx].get_weights())[0].shape[-1])
-        test_filters  = np.delete(total_filters, nodeB_idxs)
-        layer_weights = np.array(modelP.layers[nodeB_idx].get_weights().copy())
-        occluded_weights = layer_weights.copy()
-        for j in test_filters:
-                occluded_weights[0][:,:,:,j] = 0
-                try: occluded_weights[1][j] = 0
-                except: pass
-        modelP.layers[nodeB_idx].set_weights(occluded_weights)
+        # do(C_q-j = 0): zeroing a filter of nodeB only changes its own channel
+        nodeB_layer  = self.model.get_layer(nodeB_info['layer_name'])
+        nchannels    = int(nodeB_layer.get_output_at(0).shape[-1])
+        filter_idxs  = np.array(nodeB_info['filter_idxs'], dtype='int64')
+        other_idxs   = np.delete(np.arange(nchannels), filter_idxs)
+        maskB = np.zeros(nchannels, dtype=np.float32)
+        maskB[filter_idxs] = 1
 
         #########################
-        true_distributionB = []
-        predicted_distributionB = []
-
         input_paths = os.listdir(dataset_path)
         max_samples = len(input_paths) if max_samples == -1 else max_samples
-        
-        for i in range(len(input_paths) if len(input_paths) < max_samples else max_samples):
-            input_, label_ = loader(os.path.join(dataset_path, input_paths[i]))
-            pre_intervened = np.squeeze(modelT.predict(input_[None, ...]))
-            post_intervened = np.squeeze(modelP.predict(input_[None, ...]))
-            true_distributionB.append(pre_intervened)
-            predicted_distributionB.append(post_intervened)
-
+        input_paths = input_paths[:max_samples]
+
+        histogram = JointHistogram(len(filter_idxs), bins = bins)
+        pending, vmin, vmax = [], None, None
+        for pre_intervened, post_intervened in self._intervened_batches_(split, maskA, maskB, nodeB_value, 
+                                                    input_paths, dataset_path, loader, batch_size):
+            ncells = pre_intervened.shape[1]
+            other  = pre_intervened[..., other_idxs].reshape(len(pre_intervened), -1)
+            vmin = other.min(axis=0) if vmin is None else np.minimum(vmin, other.min(axis=0))
+            vmax = other.max(axis=0) if vmax is None else np.maximum(vmax, other.max(axis=0))
+
+            pending.append((pre_intervened[..., filter_idxs], post_intervened[..., filter_idxs]))
+            if ranges is None:
+                if sum([len(x) for x, _ in pending]) < calibration_samples:
+                    continue
+                ranges = self._calibrate_ranges_(pending, calibration_samples)
+            self._update_histogram_(histogram, pending, ranges)
+            pending = []
+
+        if len(pending):
+            # fewer samples than calibration_samples
+            self._update_histogram_(histogram, pending, self._calibrate_ranges_(pending, calibration_samples))
+
+        nconstant = np.sum(vmin == vmax)
+        return (ncells*np.sum(histogram.nmi()) + nconstant)/float(ncells*nchannels)
+
+
+    def _edge_tag_(self, nodeA_info, nodeB_info, dataset_path, max_samples, bins):
+        r"""
+        identifier of an edge stored with its weight in edge log, a logged
+        weight is only reused for same nodes (concept name, layer and 
+        filters), dataset, max_samples, bins and model weights
+        """
+        node_tag = lambda info: {'concept_name': str(info['concept_name']),
+                                    'layer_name': str(info['layer_name']),
+                                    'filter_idxs': [int(idx) for idx in info['filter_idxs']]}
+        return {'nodeA': node_tag(nodeA_info), 
+                'nodeB': node_tag(nodeB_info),
+                'dataset': os.path.realpath(dataset_path),
+                'max_samples': max_samples,
+                'bins': bins,
+                'weights': os.path.realpath(self.weights)}
+
+
+    def _read_edge_log_(self, log_path):
+        r"""
+        edge weights from edge log keyed by json dump of their edge tag,
+        a partially written last line (interrupted run) is ignored
+        """
+        edges = {}
+        if not os.path.exists(log_path):
+            return edges
 
-        del modelP, modelT
-        return self.MI(np.array(true_distributionB), np.array(predicted_distributionB))
+        with open(log_path, 'r') as f:
+            for line in f:
+                try:
+                    edge = json.loads(line)
+                except ValueError:
+                    continue
+                weight = edge.pop('weight', None)
+                edges[json.dumps(edge, sort_keys = True)] = weight
+        return edges
+
+
+    def compute_edges(self, pairs, 
+                        dataset_path, 
+                        dataloader, 
+                        log_path, 
+                        max_samples = 10, 
+                        bins = 100,
+                        nworkers = 1, 
+                        custom_objects = None):
+        r"""
+        computes weights of all the given node pairs, every computed
+        weight is appended to an edge log, tagged with nodes, dataset,
+        max_samples, bins and model weights (see _edge_tag_), and is 
+        never recomputed for the same tag
+
+        pairs   : list of (nodeA_info, nodeB_info)
+        log_path: <str> path to edge log (.jsonl)
+        bins    : bins used in creating histograms
+        nworkers: number of worker processes, each worker builds its own
+                    model from model json and weights, so dataloader
+                    needs to be picklable (module level)
+        custom_objects: custom layers required to rebuild model in workers
+
+        returns dict with (nodeA, nodeB) concept names as key and 
+        edge weight as value
+        """
+        logged = self._read_edge_log_(log_path)
+        tags   = {}
+        edges  = {}
+        pending = []
+        for nodei_info, nodej_info in pairs:
+            nodei, nodej = str(nodei_info['concept_name']), str(nodej_info['concept_name'])
+            tags[(nodei, nodej)] = self._edge_tag_(nodei_info, nodej_info, dataset_path, max_samples, bins)
+            key = json.dumps(tags[(nodei, nodej)], sort_keys = True)
+            if key in logged:
+                edges[(nodei, nodej)] = logged[key]
+            else:
+                pending.append((nodei, nodej, nodei_info, nodej_info, 
+                                    dataset_path, dataloader, max_samples, bins))
+
+        if nworkers > 1 and len(pending):
+            # spawn, tensorflow sessions do not survive a fork
+            pool = multiprocessing.get_context('spawn').Pool(nworkers, 
+                            initializer = _init_worker_, 
+                            initargs = (self.model.to_json(), self.weights, 
+                                        self.classinfo, custom_objects))
+            results = pool.imap_unordered(_worker_link_, pending)
+        else:
+            pool = None
+            results = (self._serial_link_(args) for args in pending)
+
+        try:
+            with open(log_path, 'a+') as f:
+                # terminates partially written line of an interrupted run
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if not f.read(1) == '\n':
+                        f.write('\n')
+
+                for nodei, nodej, link_info in tqdm(results, total = len(pending)):
+                    edge = dict(tags[(nodei, nodej)], weight = float(link_info))
+                    f.write(json.dumps(edge, sort_keys = True) + '\n')
+                    f.flush()
+                    edges[(nodei, nodej)] = float(link_info)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return edges
+
+
+    def _serial_link_(self, args):
+        r"""
+        computes weight of a single edge in this process
+        """
+        nodei, nodej, nodei_info, nodej_info, dataset_path, loader, max_samples, bins = args
+        link_info = self.get_link(nodei_info, nodej_info,
+                                    dataset_path = dataset_path,
+                                    loader = loader,
+                                    max_samples = max_samples,
+                                    bins = bins)
+        return nodei, nodej, link_info
 
 
     def generate_graph(self, graph_info, 
@@ -206,7 +550,10 @@ class CausalGraph():
                            edge_threshold = 0.5, 
                            save_path = None, 
                            verbose = True, 
-                           max_samples=10):
+                           max_samples=10,
+                           bins = 100,
+                           nworkers = 1,
+                           custom_objects = None):
         r"""
         
         Constructs entire concept graph based on the information provided
@@ -227,6 +574,16 @@ class CausalGraph():
         verbose: <bool> provide log statements
         max_samples : maximum number of samples required for expectation
                          if -1 considers all images in provided root dir
+        bins        : bins used in creating histograms
+        nworkers    : number of worker processes for computing edges
+        custom_objects: custom layers required to rebuild model in workers
+
+        Edge weights are logged in causal_edges.jsonl in save_path, tagged
+        with nodes, dataset, max_samples, bins and model weights, so an
+        interrupted run resumes and rerunning with a different 
+        edge_threshold needs no inference. Graph is saved both as pgm 
+        graph (causal_graph.pickle) and in SparseGraph format 
+        (causal_graph directory)
         
         """
 
@@ -259,18 +616,35 @@ class CausalGraph():
         node_indexing = np.array(node_indexing)
         node_ordering = np.array(node_ordering)
         
+        node_infos = {}
+        for nodei in node_ordering:
+            node_infos[nodei] = {'concept_name': nodei, 
+                            'layer_name': layers[concept_names == nodei][0], 
+                            'filter_idxs': filter_idxs[concept_names == nodei][0],
+                            'description': descp[concept_names == nodei][0]}
+
+        pairs = [(node_infos[nodei], node_infos[nodej]) 
+                    for idxi, nodei in zip(node_indexing, node_ordering)
+                    for nodej in node_ordering[node_indexing > idxi]]
+
+        os.makedirs(save_path, exist_ok=True)
+        edges = self.compute_edges(pairs, dataset_path, dataloader, 
+                                    log_path = os.path.join(save_path, 'causal_edges.jsonl'),
+                                    max_samples = max_samples,
+                                    bins = bins,
+                                    nworkers = nworkers,
+                                    custom_objects = custom_objects)
+
         rootNode = Node('Input')
         rootNode.info = {'concept_name': 'Input Image',
                             'layer_name': 'Placeholder',
                             'filter_idxs': [0],
                             'description': 'Input Image to a network'}
         self.causal_BN = Graph(rootNode)
+        sparse_edges = []
 
         for ii, (idxi, nodei) in enumerate(zip(node_indexing, node_ordering)):
-            nodei_info = {'concept_name': nodei, 
-                            'layer_name': layers[concept_names == nodei][0], 
-                            'filter_idxs': filter_idxs[concept_names == nodei][0],
-                            'description': descp[concept_names == nodei][0]}
+            nodei_info = node_infos[nodei]
 
             try:
                 Nodei = self.causal_BN.get_node(nodei)
@@ -281,6 +655,7 @@ class CausalGraph():
 
             if nodei_info['layer_name'] == layer_names[0]:
                 self.causal_BN.add_node(nodei, parentNodes = ['Input'])
+                sparse_edges.append(('Input', nodei, 1.))
                 self.causal_BN.get_node(nodei)
                 self.causal_BN.current_node.info = nodei_info
                 Aexists = True
@@ -289,16 +664,8 @@ class CausalGraph():
             for jj, (idxj, nodej) in enumerate(zip(node_indexing[node_indexing > idxi], 
                                                         node_ordering[node_indexing > idxi])):
 
-                nodej_info = {'concept_name': nodej, 
-                                'layer_name': layers[concept_names == nodej][0], 
-                                'filter_idxs': filter_idxs[concept_names == nodej][0],
-                                'description': descp[concept_names == nodej][0]}
-
-                link_info = self.get_link(nodei_info,
-                                            nodej_info,
-                                            dataset_path = dataset_path,
-                                            loader = dataloader,
-                                            max_samples = max_samples)
+                nodej_info = node_infos[nodej]
+                link_info  = edges[(str(nodei), str(nodej))]
 
                 try:
                     Nodej =self.causal_BN.get_node(nodej)
@@ -316,19 +683,24 @@ class CausalGraph():
                         if not Bexists:
                             self.causal_BN.add_node(nodej,
                                         parentNodes = [nodei])
+                            sparse_edges.append((nodei, nodej, link_info))
                             self.causal_BN.get_node(nodej)
                             self.causal_BN.current_node.info = nodej_info
                         else:
                             self.causal_BN.add_edge(nodei, nodej)
+                            sparse_edges.append((nodei, nodej, link_info))
                     else:
                         pass
 
 
             self.causal_BN.print(rootNode)
 
-        os.makedirs(save_path, exist_ok=True)
         pickle.dump({'graph': self.causal_BN, 'rootNode': rootNode}, 
                         open(os.path.join(save_path, 'causal_graph.pickle'), 'wb'))
+
+        self.sparse_graph = SparseGraph.from_edges([dict(rootNode.info, concept_name = 'Input')] + [node_infos[node] for node in node_ordering], 
+                                                    sparse_edges)
+        self.sparse_graph.save(os.path.join(save_path, 'causal_graph'))
         print("[INFO: BioExp Graphs] Causal Graph Generated")
         pass
 
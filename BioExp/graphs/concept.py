@@ -13,6 +13,9 @@ import matplotlib.gridspec as gridspec
 
 import pandas as pd
 from ..helpers.utils import *
+from ..helpers.store import ActivationStore
+from ..helpers.extractor import FeatureExtractor
+from .sparse import SparseGraph
 from ..spatial.ablation import Ablate
 from ..clusters.clusters import Cluster
 
@@ -84,77 +87,99 @@ class ConceptGraph():
 		"""
 			links is some norm information of feature activation maps
 
-			fmaps: activation maps
+			fmaps: activation maps (array or ActivationStore)
 		"""
+		if isinstance(fmaps, ActivationStore):
+			return fmaps.norm()
 		return np.linalg.norm(fmaps)
 		
-	def generate_fmaps(self, nodeA_info, nodeB_info, dataset_path, loader, save_path):
+	def _get_stores_(self, nodeA_info, nodeB_infos, dataset_path, loader, save_path, extractor=None):
 		"""
-			get link between two nodes, nodeA, nodeB
-			occlude at nodeA and observe changes in nodeB
+			activation stores of nodeBs with nodeA occluded, activations of
+			all nodeBs are extracted together in a single pass
 
-			nodeA_info    : {'layer_name', 'layer_idxs'}
-			nodeB_info    : {'layer_name', 'layer_idxs'}
+			nodeA_info    : {'concept_name', 'layer_name', 'layer_idxs'}
+			nodeB_infos   : list of {'concept_name', 'layer_name', 'layer_idxs'}
+			extractor     : FeatureExtractor on self.model tapping all the 
+							nodeB layers, built for pending nodeBs if None
 		"""
 
+		stores  = {}
+		pending = []
+		for nodeB_info in nodeB_infos:
+			name = 'A_{}_B_{}'.format(nodeA_info['concept_name'], nodeB_info['concept_name'])
+			if os.path.exists(os.path.join(save_path, name + '_fmaps.npy')):
+				stores[name] = np.load(os.path.join(save_path, name + '_fmaps.npy'), mmap_mode='r') 
+			else:
+				stores[name] = ActivationStore(os.path.join(save_path, 'activations'), name)
+				if not stores[name].complete:
+					pending.append((name, nodeB_info))
+
+		if not len(pending):
+			return stores
+
+		self.model.load_weights(self.weights, by_name = True)
 		nodeA_idx   = self.get_layer_idx(nodeA_info['layer_name'])
 		nodeA_idxs  = nodeA_info['layer_idxs']
 
-		nodeB_idx   = self.get_layer_idx(nodeB_info['layer_name'])
-		nodeB_idxs  = nodeB_info['layer_idxs']
-
-
-		model = Model(inputs=self.model.input, outputs=self.model.get_layer(nodeB_info['layer_name']).output)
-		model.load_weights(self.weights, by_name = True)
-
 		try:
-			self.layer_weights = np.array(model.layers[nodeA_idx].get_weights())
+			self.layer_weights = np.array(self.model.layers[nodeA_idx].get_weights())
 			occluded_weights = self.layer_weights.copy()
 
 			for j in nodeA_idxs:
 				occluded_weights[0][:,:,:,j] = 0
 				occluded_weights[1][j] = 0
 
-			model.layers[nodeA_idx].set_weights(occluded_weights)
+			self.model.layers[nodeA_idx].set_weights(occluded_weights)
 		except:
-			print ("nodeA is ahead of nodeB")
+			print ("nodeA can not be occluded")
 
-		if os.path.exists(os.path.join(save_path, 'A_{}_B_{}_fmaps.npy'.format(nodeA_info['concept_name'], nodeB_info['concept_name']))):
-			fmaps = np.load(os.path.join(save_path, 'A_{}_B_{}_fmaps.npy'.format(nodeA_info['concept_name'], nodeB_info['concept_name']))) 
+		if extractor is None:
+			extractor = FeatureExtractor(self.model, [nodeB_info['layer_name'] for _, nodeB_info in pending])
+		for name, _ in pending:
+			stores[name].reset()
 
-		else:
-			fmaps = []
-			input_paths = os.listdir(dataset_path)
+		for outputs in extractor.extract_dataset(dataset_path, loader, max_samples = 500):
+			for name, nodeB_info in pending:
+				stores[name].append(outputs[nodeB_info['layer_name']][..., nodeB_info['layer_idxs']])
 
-			for i in range(len(input_paths) if len(input_paths) < 500 else 500):
-				print ("[INFO: BioExp] Slice no -- Working on {}".format(i))
-				input_, label_ = loader(os.path.join(dataset_path, input_paths[i]), 
-										os.path.join(dataset_path, 
-													input_paths[i]).replace('mask', 'label').replace('labels', 'masks'))
-				output = np.squeeze(model.predict(input_[None, ...]))
-				output = output[:,:, nodeB_idxs]
-				fmaps.append(output)
+		for name, _ in pending:
+			stores[name].close()
 
-			fmaps = np.array(fmaps)
+		self.model.load_weights(self.weights, by_name = True)
+		return stores
 
-			if not os.path.exists(save_path): 
-				os.makedirs(save_path)
 
-			np.save(os.path.join(save_path, 'A_{}_B_{}_fmaps.npy'.format(nodeA_info['concept_name'], nodeB_info['concept_name'])), fmaps)
+	def generate_fmaps(self, nodeA_info, nodeB_info, dataset_path, loader, save_path):
+		"""
+			get link between two nodes, nodeA, nodeB
+			occlude at nodeA and observe changes in nodeB
+
+			nodeA_info    : {'layer_name', 'layer_idxs'}
+			nodeB_info    : {'layer_name', 'layer_idxs'}
+		"""
 
+		name   = 'A_{}_B_{}'.format(nodeA_info['concept_name'], nodeB_info['concept_name'])
+		stores = self._get_stores_(nodeA_info, [nodeB_info], dataset_path, loader, save_path)
 
-		link = self.generate_link(fmaps)
+		link = self.generate_link(stores[name])
 		return link
 
 
-	def generate_graph(self, graph_info, dataset_path = None, loader = None, save_path=None):
+	def generate_graph(self, graph_info, dataset_path = None, loader = None, save_path=None, sparse=False):
 		"""
-			generates graph adj matrix for computation
+			generates graph adj matrix for computation, graph is also
+			saved in SparseGraph format in save_path/concept_graph
 
 			graph_info: {'concept_name', 'layer_name', 'feature_map_idxs'}
 			save_path : graph_path or path to save graph
+			sparse    : returns SparseGraph instead of adj matrix if True
 		"""
 
+		sparse_path = os.path.join(save_path, 'concept_graph')
+		if sparse and SparseGraph.exists(sparse_path):
+			return SparseGraph.load(sparse_path)
+
 		if os.path.exists(os.path.join(save_path, 'concept_adj_matrix.pickle')):
 			with open(os.path.join(save_path, 'concept_adj_matrix.pickle'), 'rb') as f:
 				AM = pickle.load(f) 
@@ -162,23 +187,37 @@ class ConceptGraph():
 		else:
 			nodes = len(graph_info['concept_name'])
 
+			node_infos = [{'concept_name': graph_info['concept_name'][node],
+							'layer_name': graph_info['layer_name'][node],
+							'layer_idxs': graph_info['feature_map_idxs'][node]} for node in range(nodes)]
+
+			# shares layers with self.model, so it sees the occluded weights
+			extractor = FeatureExtractor(self.model, [node_info['layer_name'] for node_info in node_infos])
+
 			AM = []
 			for nodeA in range(nodes):
+				# all nodeBs of an occluded nodeA in one pass
+				stores = self._get_stores_(node_infos[nodeA], node_infos,
+												dataset_path = dataset_path, 
+												loader = loader, 
+												save_path = save_path,
+												extractor = extractor)
 				AM_row = []
 				for nodeB in range(nodes):
-					nodeA_info = {'concept_name': graph_info['concept_name'][nodeA],
-									'layer_name': graph_info['layer_name'][nodeA],
-									'layer_idxs': graph_info['feature_map_idxs'][nodeA]}
-					nodeB_info = {'concept_name': graph_info['concept_name'][nodeB],
-									'layer_name': graph_info['layer_name'][nodeB],
-									'layer_idxs': graph_info['feature_map_idxs'][nodeB]}
-					AM_row.append(self.generate_fmaps(nodeA_info, nodeB_info,
-													dataset_path = dataset_path, 
-													loader = loader, 
-													save_path = save_path))
+					name = 'A_{}_B_{}'.format(node_infos[nodeA]['concept_name'], node_infos[nodeB]['concept_name'])
+					AM_row.append(self.generate_link(stores[name]))
 				AM.append(AM_row)
 
 			with open(os.path.join(save_path, 'concept_adj_matrix.pickle'), 'wb') as f:
 				pickle.dump(AM, f) 
 
+		node_info = [{'concept_name': graph_info['concept_name'][node],
+						'layer_name': graph_info['layer_name'][node],
+						'filter_idxs': graph_info['feature_map_idxs'][node]} 
+						for node in range(len(graph_info['concept_name']))]
+		graph = SparseGraph.from_dense(node_info, AM)
+		graph.save(sparse_path)
+
+		if sparse:
+			return graph
 		return AM
\ No newline at end of file
@@ -7,15 +7,47 @@ import os
 import pdb
 import cv2 
 import pickle
+import json
+import multiprocessing
+from collections import OrderedDict
 from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
 from tqdm import tqdm
 
 import pandas as pd
 from ..helpers.utils import *
+from ..helpers.metrics import class_scores
+from ..helpers.baseline import baseline_cache
+from ..helpers.layersplit import LayerSplit
+from .sparse import SparseGraph
 from ..spatial.ablation import Ablate
 
-from keras.models import Model
+from keras.models import Model, model_from_json
+
+
+_worker_graph = None
+
+def _init_worker_(model_json, weights_pth, metric, classinfo, custom_objects):
+	"""
+		builds a private model instance in every worker process
+	"""
+	global _worker_graph
+	model = model_from_json(model_json, custom_objects = custom_objects)
+	model.load_weights(weights_pth, by_name = True)
+	_worker_graph = DeltaGraph(model, weights_pth, metric, classinfo)
+
+
+def _worker_link_(args):
+	"""
+		computes a single cell of adjacency matrix in a worker process
+	"""
+	nodeA, nodeB, nodeA_info, nodeB_info, dataset_path, loader, save_path, max_samples = args
+	link = _worker_graph.get_link(nodeA_info, nodeB_info,
+									dataset_path = dataset_path, 
+									loader = loader, 
+									save_path = save_path,
+									max_samples = max_samples)
+	return nodeA, nodeB, link
 
 
 class DeltaGraph():
@@ -23,7 +55,7 @@ class DeltaGraph():
 	A class for generating concept graph on a trained keras model instance
 	"""     
 
-	def __init__(self, model, weights_pth, metric, classinfo=None):
+	def __init__(self, model, weights_pth, metric, classinfo=None, cache=None, max_frontiers=16):
 		
 		"""
 			model       : keras model architecture (keras.models.Model)
@@ -32,6 +64,9 @@ class DeltaGraph():
 			layer_name  : name of the layer which needs to be ablated
 			test_img    : test image used for ablation
 			max_clusters: maximum number of clusters per layer
+			cache       : BaselineCache for unablated predictions,
+							shared module level cache if None
+			max_frontiers: maximum number of cached upstream activations
 		"""     
 
 		self.model      = model
@@ -40,6 +75,12 @@ class DeltaGraph():
 		self.metric     = metric
 		self.classinfo  = classinfo
 		self.noutputs   = len(self.model.outputs)
+		self.cache      = baseline_cache if cache is None else cache
+		self.model.load_weights(self.weights, by_name = True)
+
+		self.max_frontiers = max_frontiers
+		self._splits       = {}
+		self._frontiers    = OrderedDict()
 
 	def get_layer_idx(self, layer_name):
 		for idx, layer in enumerate(self.model.layers):
@@ -86,7 +127,8 @@ class DeltaGraph():
 									os.path.join(dataset_path, 
 									input_paths[i]).replace('mask', 'label').replace('labels', 'masks'))
 				prediction_occluded = np.squeeze(self.modelcopy.predict(input_[None, ...]))
-				prediction = np.squeeze(self.model.predict(input_[None, ...]))
+				prediction = self.cache.predict(self.model, self.weights, 
+									os.path.join(dataset_path, input_paths[i]), input_)
 				
 				idx = 0
 				if self.noutputs > 1:
@@ -95,13 +137,14 @@ class DeltaGraph():
 							idx = ii 
 							break;
 
-				for class_ in self.classinfo.keys():
-					if self.noutputs > 1:
-						dice_json[class_].append(self.metric(label_, prediction[idx].argmax(axis = -1), self.classinfo[class_]) - 
-									self.metric(label_, prediction_occluded[idx].argmax(axis = -1), self.classinfo[class_]))
-					else:
-						dice_json[class_].append(self.metric(label_, prediction.argmax(axis = -1), self.classinfo[class_]) - 
-									self.metric(label_, prediction_occluded.argmax(axis = -1), self.classinfo[class_]))
+				if self.noutputs > 1:
+					predictions = np.array([prediction[idx], prediction_occluded[idx]])
+				else:
+					predictions = np.array([prediction, prediction_occluded])
+				scores = class_scores(self.metric, np.squeeze(label_)[None, ...], 
+								predictions.argmax(axis = -1), self.classinfo)
+				for j, class_ in enumerate(self.classinfo.keys()):
+					dice_json[class_].append(scores[0, j] - scores[1, j])
 
 		for class_ in self.classinfo.keys():
 			dice_json[class_] = np.mean(dice_json[class_])
@@ -109,38 +152,70 @@ class DeltaGraph():
 		return dice_json 
 		
 
+	def _get_split_(self, layer_name):
+		"""
+			ablation model split at given layer, one per layer
+		"""
+		if not layer_name in self._splits:
+			self._splits[layer_name] = LayerSplit(self.modelcopy, layer_name)
+		return self._splits[layer_name]
+
+
+	def _get_frontier_(self, split, input_path, input_):
+		"""
+			upstream activations of an image at split layer, shared by
+			all the links whose earlier ablated layer is the split layer
+		"""
+		key = (split.layer_name, input_path)
+		if key in self._frontiers:
+			self._frontiers.move_to_end(key)
+			return self._frontiers[key]
+
+		frontier = split.upstream(input_[None, ...])
+		self._frontiers[key] = frontier
+		while len(self._frontiers) > self.max_frontiers:
+			self._frontiers.popitem(last = False)
+		return frontier
+
+
 	def get_link(self, nodeA_info, nodeB_info, dataset_path, loader, save_path, max_samples = 1):
 		"""
 			get link between two nodes, nodeA, nodeB
 			occlude at nodeA and observe changes in nodeB
 
+			Forward pass resumes from cached activations at the earlier
+			of both ablated layers, which is ablated by masking its output,
+			later layer is ablated by zeroing its weights
+
 			nodeA_info    : {'layer_name', 'layer_idxs'}
 			nodeB_info    : {'layer_name', 'layer_idxs'}
 		"""
 		self.modelcopy.load_weights(self.weights, by_name = True)
-		self.model.load_weights(self.weights, by_name = True)
 
 		nodeA_idx   = self.get_layer_idx(nodeA_info['layer_name'])
-		nodeA_idxs  = nodeA_info['filter_idxs']
-
 		nodeB_idx   = self.get_layer_idx(nodeB_info['layer_name'])
-		nodeB_idxs  = nodeB_info['filter_idxs']
 
+		if nodeA_idx <= nodeB_idx:
+			first_info, second_info = nodeA_info, nodeB_info
+		else:
+			first_info, second_info = nodeB_info, nodeA_info
 
-		layer_weights = np.array(self.modelcopy.layers[nodeA_idx].get_weights())
-		occluded_weights = layer_weights.copy()
-		for j in nodeA_idxs:
-			occluded_weights[0][:,:,:,j] = 0
-			occluded_weights[1][j] = 0
-		self.modelcopy.layers[nodeA_idx].set_weights(occluded_weights)
+		split = self._get_split_(first_info['layer_name'])
+		filter_idxs = list(first_info['filter_idxs'])
 
-		layer_weights = np.array(self.modelcopy.layers[nodeB_idx].get_weights())
-		occluded_weights = layer_weights.copy()
+		if first_info['layer_name'] == second_info['layer_name']:
+			filter_idxs += list(second_info['filter_idxs'])
+		else:
+			second_idx = self.get_layer_idx(second_info['layer_name'])
+			layer_weights = np.array(self.modelcopy.layers[second_idx].get_weights())
+			occluded_weights = layer_weights.copy()
+
+			for j in second_info['filter_idxs']:
+				occluded_weights[0][:,:,:,j] = 0
+				occluded_weights[1][j] = 0
+			self.modelcopy.layers[second_idx].set_weights(occluded_weights)
 
-		for j in nodeB_idxs:
-			occluded_weights[0][:,:,:,j] = 0
-			occluded_weights[1][j] = 0
-		self.modelcopy.layers[nodeB_idx].set_weights(occluded_weights)
+		mask = split.get_mask(filter_idxs)
 
 		dice_json = {}
 		for class_ in self.classinfo.keys():
@@ -148,11 +223,13 @@ class DeltaGraph():
 
 		input_paths = os.listdir(dataset_path)
 		for i in range(len(input_paths) if len(input_paths) < max_samples else max_samples):
-			input_, label_ = loader(os.path.join(dataset_path, input_paths[i]), 
-								os.path.join(dataset_path, 
-								input_paths[i]).replace('mask', 'label').replace('labels', 'masks'))
-			prediction_occluded = np.squeeze(self.modelcopy.predict(input_[None, ...]))
-			prediction = np.squeeze(self.model.predict(input_[None, ...]))
+			input_path = os.path.join(dataset_path, input_paths[i])
+			input_, label_ = loader(input_path, 
+								input_path.replace('mask', 'label').replace('labels', 'masks'))
+			frontier = self._get_frontier_(split, input_path, input_)
+			prediction_occluded = split.downstream(frontier, mask)
+			prediction_occluded = np.squeeze(prediction_occluded[0] if self.noutputs == 1 else prediction_occluded)
+			prediction = self.cache.predict(self.model, self.weights, input_path, input_)
 
 			idx = 0
 			if self.noutputs > 1:
@@ -162,13 +239,14 @@ class DeltaGraph():
 						break;
 
 
-			for class_ in self.classinfo.keys():
-				if self.noutputs > 1:
-					dice_json[class_].append(self.metric(label_, prediction[idx].argmax(axis = -1), self.classinfo[class_]) - 
-								self.metric(label_, prediction_occluded[idx].argmax(axis = -1), self.classinfo[class_]))
-				else:
-					dice_json[class_].append(self.metric(label_, prediction.argmax(axis = -1), self.classinfo[class_]) - 
-								self.metric(label_, prediction_occluded.argmax(axis = -1), self.classinfo[class_]))
+			if self.noutputs > 1:
+				predictions = np.array([prediction[idx], prediction_occluded[idx]])
+			else:
+				predictions = np.array([prediction, prediction_occluded])
+			scores = class_scores(self.metric, np.squeeze(label_)[None, ...], 
+							predictions.argmax(axis = -1), self.classinfo)
+			for j, class_ in enumerate(self.classinfo.keys()):
+				dice_json[class_].append(scores[0, j] - scores[1, j])
 
 
 		for class_ in self.classinfo.keys():
@@ -177,61 +255,173 @@ class DeltaGraph():
 		return dice_json
 
 
+	def _dataset_tag_(self, dataset_path):
+		"""
+			dataset identifier stored with every checkpoint cell
+		"""
+		return None if dataset_path is None else os.path.realpath(dataset_path)
+
+
+	def _cell_tag_(self, nodeA_info, nodeB_info, dataset_path, max_samples):
+		"""
+			identifier of a cell stored with its link in checkpoint log, 
+			a finished cell is only reused for same nodes (concept name,
+			layer and filters), dataset, max_samples and model weights,
+			not for same positions in graph_info
+		"""
+		node_tag = lambda info: {'concept_name': str(info['concept_name']),
+									'layer_name': str(info['layer_name']),
+									'filter_idxs': [int(idx) for idx in info['filter_idxs']]}
+		return {'nodeA': node_tag(nodeA_info), 
+				'nodeB': node_tag(nodeB_info),
+				'dataset': self._dataset_tag_(dataset_path),
+				'max_samples': max_samples,
+				'weights': os.path.realpath(self.weights)}
+
+
+	def _read_checkpoint_(self, checkpoint_path):
+		"""
+			finished cells of adjacency matrix from checkpoint log keyed by 
+			json dump of their cell tag, a partially written last line 
+			(interrupted run) is ignored
+		"""
+		links = {}
+		if not os.path.exists(checkpoint_path):
+			return links
+
+		with open(checkpoint_path, 'r') as f:
+			for line in f:
+				try:
+					cell = json.loads(line)
+				except ValueError:
+					continue
+				link = cell.pop('link', None)
+				links[json.dumps(cell, sort_keys = True)] = link
+		return links
+
+
 	def generate_graph(self, graph_info, 
 							dataset_path = None, 
 							loader = None, 
 							save_path=None, 
 							max_samples = 1, 
-							nmontecarlo = 10):
+							nmontecarlo = 10,
+							nworkers = 1,
+							custom_objects = None,
+							sparse = False):
 		"""
 			generates graph adj matrix for computation
 
+			Every finished cell is appended to concept_adj_matrix_cells.jsonl
+			in save_path, tagged with both nodes, dataset path, max_samples
+			and weights path, an interrupted run resumes from the finished 
+			cells with same tags.
+			With nworkers > 1 node pairs are spread over a process pool,
+			each worker builds its own model instance from model json and
+			weights, so metric and loader need to be picklable (module level)
+
 			graph_info: [{'concept_name', 'layer_name', 'filter_idxs'}]
 			save_path : graph_path or path to save graph
+			nworkers  : number of worker processes
+			custom_objects: custom layers required to rebuild model in workers
+			sparse    : returns {class: SparseGraph} instead of adj matrices
+						if True, graph of each class is also saved in 
+						SparseGraph format in save_path/delta_graph_<class>
 		"""
 
+		sparse_paths = {class_: os.path.join(save_path, 'delta_graph_{}'.format(class_)) 
+							for class_ in self.classinfo.keys()}
+		if sparse and all([SparseGraph.exists(path) for path in sparse_paths.values()]):
+			return {class_: SparseGraph.load(path) for class_, path in sparse_paths.items()}
+
 		if os.path.exists(os.path.join(save_path, 'concept_adj_matrix.pickle')):
 			with open(os.path.join(save_path, 'concept_adj_matrix.pickle'), 'rb') as f:
 				AM = pickle.load(f) 
-
+			return self._to_sparse_(graph_info, AM, sparse_paths) if sparse else AM
+
+		os.makedirs(save_path, exist_ok = True)
+		checkpoint_path = os.path.join(save_path, 'concept_adj_matrix_cells.jsonl')
+
+		nodes    = len(graph_info)
+		finished = self._read_checkpoint_(checkpoint_path)
+		tags     = {}
+		links    = {}
+		pending  = []
+		for nodeA in range(nodes):
+			for nodeB in range(nodes):
+				tags[(nodeA, nodeB)] = self._cell_tag_(graph_info[nodeA], graph_info[nodeB], 
+															dataset_path, max_samples)
+				key = json.dumps(tags[(nodeA, nodeB)], sort_keys = True)
+				if key in finished:
+					links[(nodeA, nodeB)] = finished[key]
+				else:
+					pending.append((nodeA, nodeB, graph_info[nodeA], graph_info[nodeB], 
+										dataset_path, loader, save_path, max_samples))
+		if len(links):
+			print ("[INFO: BioExp Graphs] Resuming, {} of {} links already computed".format(len(links), nodes**2))
+
+		if nworkers > 1 and len(pending):
+			# spawn, tensorflow sessions do not survive a fork
+			pool = multiprocessing.get_context('spawn').Pool(nworkers, 
+							initializer = _init_worker_, 
+							initargs = (self.model.to_json(), self.weights, 
+										self.metric, self.classinfo, custom_objects))
+			results = pool.imap_unordered(_worker_link_, pending)
 		else:
-			nodes = len(graph_info)
+			pool = None
+			results = (self._serial_link_(args) for args in pending)
+
+		try:
+			with open(checkpoint_path, 'a+') as f:
+				# terminates partially written line of an interrupted run
+				if f.tell() > 0:
+					f.seek(f.tell() - 1)
+					if not f.read(1) == '\n':
+						f.write('\n')
+				for nodeA, nodeB, link in tqdm(results, total = len(pending)):
+					link = {class_: float(link[class_]) for class_ in self.classinfo.keys()}
+					cell = dict(tags[(nodeA, nodeB)], link = link)
+					f.write(json.dumps(cell, sort_keys = True) + '\n')
+					f.flush()
+					links[(nodeA, nodeB)] = link
+		finally:
+			if pool is not None:
+				pool.terminate()
+
+		AM = {}
+		for class_ in self.classinfo.keys():
+			AM[class_] = [[links[(nodeA, nodeB)][class_] for nodeB in range(nodes)] 
+							for nodeA in range(nodes)]
 
-			AM = {}
-			for class_ in self.classinfo.keys():
-				AM[class_] = []
-
-			for nodeA in tqdm(range(nodes)):
-				AM_row = {}
-				for class_ in self.classinfo.keys():
-					AM_row[class_] = []
-
-
-				for nodeB in tqdm(range(nodes)):
-					if nodeA == nodeB:
-						node_info = graph_info[nodeA]
-
-						significance_dice = self.significance_test(node_info,
-														dataset_path, loader, 
-														nmontecarlo = nmontecarlo,
-														max_samples = max_samples )
-					nodeA_info = graph_info[nodeA]
-					nodeB_info = graph_info[nodeB]
-					link = self.get_link(nodeA_info, nodeB_info,
-													dataset_path = dataset_path, 
-													loader = loader, 
-													save_path = save_path,
-													max_samples = max_samples)
-					for class_ in self.classinfo.keys():
-						AM_row[class_].append(link[class_])
-				
-				for class_ in self.classinfo.keys():
-					AM[class_].append(AM_row[class_])
+		with open(os.path.join(save_path, 'concept_adj_matrix.pickle'), 'wb') as f:
+			pickle.dump(AM, f) 
+
+		graphs = self._to_sparse_(graph_info, AM, sparse_paths)
+		return graphs if sparse else AM
 
-			with open(os.path.join(save_path, 'concept_adj_matrix.pickle'), 'wb') as f:
-				pickle.dump(AM, f) 
 
-		return AM
+	def _to_sparse_(self, graph_info, AM, sparse_paths):
+		"""
+			saves adjacency matrix of each class in SparseGraph format
+		"""
+		graphs = {}
+		for class_ in self.classinfo.keys():
+			graphs[class_] = SparseGraph.from_dense(graph_info, AM[class_])
+			graphs[class_].save(sparse_paths[class_])
+		return graphs
+
+
+	def _serial_link_(self, args):
+		"""
+			computes a single cell of adjacency matrix in this process
+		"""
+		nodeA, nodeB, nodeA_info, nodeB_info, dataset_path, loader, save_path, max_samples = args
+		link = self.get_link(nodeA_info, nodeB_info,
+								dataset_path = dataset_path, 
+								loader = loader, 
+								save_path = save_path,
+								max_samples = max_samples)
+		return nodeA, nodeB, link
 
 	def node_significance(self, graph_info, dataset_path = None, loader = None, save_path=None, max_samples = 1, nmontecarlo = 10):
 		"""
@@ -9,6 +9,9 @@ import pickle
 
 import pandas as pd
 from ..helpers.utils import *
+from ..helpers.metrics import class_scores
+from ..helpers.baseline import baseline_cache
+from ..helpers.layersplit import LayerSplit
 
 from keras.models import Model
 from keras.utils import np_utils
@@ -20,7 +23,7 @@ class SignificanceTester():
 	A class for testing significance of each concepts generated in a trained keras model instance
 	"""     
 
-	def __init__(self, model, weights_pth, metric, classinfo=None):
+	def __init__(self, model, weights_pth, metric, classinfo=None, cache=None):
 		
 		"""
 			model       : keras model architecture (keras.models.Model)
@@ -29,6 +32,8 @@ class SignificanceTester():
 			layer_name  : name of the layer which needs to be ablated
 			test_img    : test image used for ablation
 			max_clusters: maximum number of clusters per layer
+			cache       : BaselineCache for unablated predictions,
+							shared module level cache if None
 		"""     
 
 		self.model      = model
@@ -37,6 +42,9 @@ class SignificanceTester():
 		self.metric     = metric
 		self.classinfo  = classinfo
 		self.noutputs   = len(self.model.outputs)
+		self.cache      = baseline_cache if cache is None else cache
+		self.model.load_weights(self.weights, by_name = True)
+		self._splits    = {}
 	
 
 	def get_layer_idx(self, layer_name):
@@ -45,79 +53,239 @@ class SignificanceTester():
 
 				return idx
 
-	def node_significance(self, concept_info, dataset_path, loader, nmontecarlo = 10, max_samples = 1):
+	def _get_split_(self, layer_name):
+		"""
+			model split at given layer, one per layer
+		"""
+		if not layer_name in self._splits:
+			self._splits[layer_name] = LayerSplit(self.model, layer_name)
+		return self._splits[layer_name]
+
+
+	def _random_masks_(self, split, node_idxs, nmontecarlo):
+		"""
+			channel masks of all montecarlo rounds, each ablating as many
+			randomly chosen filters (outside of the node) as node has
+		"""
+		total_filters = np.arange(split.nchannels)
+		test_filters  = np.delete(total_filters, node_idxs)
+
+		masks = np.ones((nmontecarlo, split.nchannels), dtype=np.float32)
+		for i in range(nmontecarlo):
+			np.random.shuffle(test_filters)
+			masks[i, test_filters[:len(node_idxs)]] = 0
+		return masks
+
+
+	def _information_gain_(self, prediction, predictions_occluded):
+		"""
+			information gain of every occluded prediction
+		"""
+		axes = tuple(range(1, predictions_occluded.ndim))
+		return np.mean(-predictions_occluded*np.log2(predictions_occluded) + prediction*np.log(prediction), axis = axes)
+
+
+	def _image_baselines_(self, split, dataset_path, loader, max_samples = 1):
+		"""
+			generator over (label, baseline prediction, output index, 
+			upstream activations) of every image
+		"""
+		input_paths = os.listdir(dataset_path)
+		for i in range(len(input_paths) if len(input_paths) < max_samples else max_samples):
+			input_path = os.path.join(dataset_path, input_paths[i])
+			input_, label_ = loader(input_path, 
+								input_path.replace('mask', 'label').replace('labels', 'masks'))
+			prediction = self.cache.predict(self.model, self.weights, input_path, input_)
+			frontier   = split.upstream(input_[None, ...])
+
+			idx = 0
+			if self.noutputs > 1:
+				for ii in range(self.noutputs):
+					if prediction[ii] == self.nclasses:
+						idx = ii 
+						break;
+				prediction = prediction[idx]
+			yield label_, prediction, idx, frontier
+
+
+	def _montecarlo_deltas_(self, split, masks, dataset_path, loader, max_samples = 1, batch_size = 8, baselines = None):
+		"""
+			generator over (image index, dice deltas (M x nclasses), 
+			information gain (M,)) for a chunk of masks of every image;
+			baseline and upstream activations are computed once per image
+			and all masks are evaluated in batched channel masked passes
+
+			baselines: list of _image_baselines_ outputs, reused instead of
+						loading images and recomputing upstream activations
+		"""
+		if baselines is None:
+			baselines = self._image_baselines_(split, dataset_path, loader, max_samples = max_samples)
+
+		for i, (label_, prediction, idx, frontier) in enumerate(baselines):
+			for st in range(0, len(masks), batch_size):
+				predictions_occluded = split.downstream(frontier, masks[st: st + batch_size], 
+											batch_size = batch_size)[idx]
+				predictions = np.concatenate([prediction[None, ...], 
+											predictions_occluded.reshape((-1,) + prediction.shape)], axis = 0)
+				scores = class_scores(self.metric, np.squeeze(label_)[None, ...], 
+								predictions.argmax(axis = -1), self.classinfo)
+				yield i, scores[:1] - scores[1:], self._information_gain_(prediction, predictions[1:])
+
+
+	def node_significance(self, concept_info, dataset_path, loader, nmontecarlo = 10, max_samples = 1, batch_size = 8):
 		"""
 			test significance of each concepts
 			concept: {'layer_name', 'filter_idxs'}
+
+			all montecarlo masks are evaluated together in batched 
+			channel masked forward passes from cached upstream activations
+			batch_size: number of masks per forward pass
 		"""
 		
-		self.model.load_weights(self.weights, by_name = True)
-		node_idx  = self.get_layer_idx(concept_info['layer_name'])
+		split     = self._get_split_(concept_info['layer_name'])
 		node_idxs = concept_info['filter_idxs']
 
-		total_filters = np.arange(np.array(self.model.layers[node_idx].get_weights())[0].shape[-1])
 		nfilters      = len(node_idxs)
-		test_filters  = np.delete(total_filters, node_idxs)
+		test_filters  = np.delete(np.arange(split.nchannels), node_idxs)
 		if len(test_filters) < nfilters:
 			print("Huge cluster size, may not be significant, cluster size: {}, total data size: {}".format(nfilters, len(test_filters)))
 			return False
 
-		input_paths = os.listdir(dataset_path)
+		masks = self._random_masks_(split, node_idxs, nmontecarlo)
+
+		deltas, gains = [], []
+		for _, delta, gain in self._montecarlo_deltas_(split, masks, dataset_path, loader, 
+												max_samples = max_samples, batch_size = batch_size):
+			deltas.append(delta)
+			gains.append(gain)
+		deltas = np.concatenate(deltas, axis = 0)
+
 		dice_json = {}
-		for class_ in self.classinfo.keys():
-			dice_json[class_] = []
-		dice_json['IG'] = [] # information gain
+		for j, class_ in enumerate(self.classinfo.keys()):
+			dice_json[class_] = np.mean(deltas[:, j])
+		
+		dice_json['IG'] = np.mean(np.concatenate(gains)) # information gain
+		return dice_json 
 
+	def _test_statistic_(self, deltas, test_class):
+		"""
+			dice delta used for testing, mean over classes if 
+			test_class is None
+		"""
+		if test_class is None:
+			return np.mean(deltas, axis = -1)
+		return deltas[..., list(self.classinfo.keys()).index(test_class)]
 
-		for _ in range(nmontecarlo):
-			np.random.shuffle(test_filters)
-			self.modelcopy.load_weights(self.weights, by_name = True)
-			layer_weights = np.array(self.modelcopy.layers[node_idx].get_weights())
-			occluded_weights = layer_weights.copy()
-
-			for j in test_filters[:nfilters]:
-				occluded_weights[0][:,:,:,j] = 0
-				occluded_weights[1][j] = 0
-
-			self.modelcopy.layers[node_idx].set_weights(occluded_weights)
-			for i in range(len(input_paths) if len(input_paths) < max_samples else max_samples):
-				input_, label_ = loader(os.path.join(dataset_path, input_paths[i]), 
-									os.path.join(dataset_path, 
-									input_paths[i]).replace('mask', 'label').replace('labels', 'masks'))
-				prediction_occluded = np.squeeze(self.modelcopy.predict(input_[None, ...]))
-				prediction = np.squeeze(self.model.predict(input_[None, ...]))
-				
-				idx = 0
-				if self.noutputs > 1:
-					for ii in range(self.noutputs):
-						if prediction[ii] == self.nclasses:
-							idx = ii 
-							break;
-
-				for class_ in self.classinfo.keys():
-					if self.noutputs > 1:
-						dice_json[class_].append(self.metric(label_, prediction[idx].argmax(axis = -1), self.classinfo[class_]) - 
-									self.metric(label_, prediction_occluded[idx].argmax(axis = -1), self.classinfo[class_]))
-					else:
-						dice_json[class_].append(self.metric(label_, prediction.argmax(axis = -1), self.classinfo[class_]) - 
-									self.metric(label_, prediction_occluded.argmax(axis = -1), self.classinfo[class_]))
-				if self.noutputs > 1:
-					dice_json['IG'].append(np.mean(-prediction_occluded[idx]*np.log2(prediction_occluded[idx]) + prediction[idx]*np.log(prediction[idx])))
-				else:
-					dice_json['IG'].append(np.mean(-prediction_occluded*np.log2(prediction_occluded) + prediction*np.log(prediction))) 
 
+	def sequential_significance(self, concept_info, dataset_path, loader, 
+									alpha = 0.05, 
+									nmontecarlo = 1000, 
+									max_samples = 1, 
+									batch_size = 8,
+									test_class = None,
+									indifference = 2.,
+									error = 0.01):
+		"""
+			sequential montecarlo permutation test of a concept
 
-		for class_ in self.classinfo.keys():
-			dice_json[class_] = np.mean(dice_json[class_])
-		
-		dice_json['IG'] = np.mean(dice_json['IG'])
-		return dice_json 
+			A node is significant if ablating it drops dice more than
+			ablating the same number of random filters, i.e. if 
+			p = P(random drop >= node drop) < alpha. Random ablations are
+			drawn in chunks of batch_size and a Wald SPRT between 
+			p = alpha/indifference (significant) and p = alpha*indifference
+			(not significant) stops sampling as soon as either is accepted
+			with error probability error, otherwise at nmontecarlo draws.
+
+			concept: {'layer_name', 'filter_idxs'}
+			alpha       : significance level
+			nmontecarlo : maximum number of random ablations
+			test_class  : class of classinfo used for testing,
+							mean over classes if None
+			indifference: ratio defining indifference region around alpha
+			error       : error probability of each SPRT decision,
+							nmontecarlo has to allow enough draws to
+							accept significance (ValueError otherwise)
+
+			images are loaded and their upstream activations computed 
+			once, every chunk of random ablations reuses them
+
+			returns dict with decision ('significant', None if undecided),
+			'pvalue', 'node_delta', number of draws and forward passes
+			used and saved
+		"""
+		split     = self._get_split_(concept_info['layer_name'])
+		node_idxs = concept_info['filter_idxs']
+		if split.nchannels - len(node_idxs) < len(node_idxs):
+			print("Huge cluster size, may not be significant, cluster size: {}, total data size: {}".format(len(node_idxs), 
+													split.nchannels - len(node_idxs)))
+			return False
+
+		p0, p1 = alpha/indifference, min(alpha*indifference, 1. - 1e-6)
+		llr_exceed, llr_below = np.log(p1/p0), np.log((1. - p1)/(1. - p0))
+		upper, lower = np.log((1. - error)/error), np.log(error/(1. - error))
+
+		# fewest draws, none exceeding the node drop, accepting significance
+		min_draws = int(np.ceil(lower/llr_below))
+		if nmontecarlo < min_draws:
+			raise ValueError("nmontecarlo = {} can never accept significance, at least {} draws are needed for alpha = {}, indifference = {}, error = {}".format(nmontecarlo, 
+									min_draws, alpha, indifference, error))
+
+		baselines = list(self._image_baselines_(split, dataset_path, loader, max_samples = max_samples))
+		nimages   = len(baselines)
+
+		deltas = []
+		for _, delta, _ in self._montecarlo_deltas_(split, split.get_mask(node_idxs)[None, ...], dataset_path, 
+												loader, batch_size = batch_size, baselines = baselines):
+			deltas.append(delta)
+		node_delta = self._test_statistic_(np.mean(np.concatenate(deltas), axis = 0), test_class)
+
+		llr, ndraws, nexceed, significant = 0., 0, 0, None
+		nevaluated = 0
+		while nevaluated < nmontecarlo and significant is None:
+			masks = self._random_masks_(split, node_idxs, min(batch_size, nmontecarlo - nevaluated))
+			nevaluated += len(masks)
 
-	def graph_significance(self, graph_info, dataset_path = None, loader = None, save_path=None, max_samples = 1, nmontecarlo = 10):
+			# mean delta of every mask over images, one chunk per image
+			chunk = np.zeros((len(masks), len(self.classinfo)))
+			for _, delta, _ in self._montecarlo_deltas_(split, masks, dataset_path, loader, 
+													batch_size = batch_size, baselines = baselines):
+				chunk += delta/nimages
+
+			for exceed in self._test_statistic_(chunk, test_class) >= node_delta:
+				ndraws  += 1
+				nexceed += int(exceed)
+				llr     += llr_exceed if exceed else llr_below
+				if llr >= upper:
+					significant = False
+				elif llr <= lower:
+					significant = True
+				if significant is not None:
+					break
+
+		# one upstream pass per image and one downstream pass per image 
+		# and mask, saved passes relative to evaluating all nmontecarlo draws
+		forward_passes = nimages + (1 + nevaluated)*nimages
+		info = {'significant': significant,
+				'pvalue': (1. + nexceed)/(1. + ndraws),
+				'node_delta': node_delta,
+				'nmontecarlo': ndraws,
+				'forward_passes': forward_passes,
+				'saved_passes': nimages + (1 + nmontecarlo)*nimages - forward_passes}
+		print ("[INFO: BioExp Significance] Layer {} -- decision: {} after {} draws, p: {:.4f}, saved {} forward passes".format(concept_info['layer_name'], 
+										significant, ndraws, info['pvalue'], info['saved_passes']))
+		return info
+
+
+	def graph_significance(self, graph_info, dataset_path = None, loader = None, save_path=None, max_samples = 1, nmontecarlo = 10,
+								sequential = False, alpha = 0.05, max_draws = 1000):
 		"""
 			generates graph adj matrix for computation
 			graph_info: {'concept_name', 'layer_name', 'feature_map_idxs'}
 			save_path : graph_path or path to save graph
+			sequential: uses sequential_significance instead of 
+						node_significance with nmontecarlo draws
+			alpha     : significance level for sequential testing
+			max_draws : maximum number of draws per node for sequential testing
 		"""
 
 		if os.path.exists(os.path.join(save_path, 'significance_info.pickle')):
@@ -132,12 +300,23 @@ class SignificanceTester():
 			for i, node in enumerate(nodes):
 				node_info = {'layer_name': graph_info['layer_name'][i], 
 								'filter_idxs':  graph_info['feature_map_idxs'][i]}
-				significance_dice = self.node_significance(node_info,
+				if sequential:
+					significance_dice = self.sequential_significance(node_info,
+										dataset_path, loader, 
+										alpha = alpha,
+										nmontecarlo = max_draws,
+										max_samples = max_samples )
+				else:
+					significance_dice = self.node_significance(node_info,
 										dataset_path, loader, 
 										nmontecarlo = nmontecarlo,
 										max_samples = max_samples )
 				
 				significance[node] = significance_dice
+
+			if sequential:
+				saved = sum([info['saved_passes'] for info in significance.values() if info])
+				print ("[INFO: BioExp Significance] Sequential testing saved {} forward passes".format(saved))
 			with open(os.path.join(save_path, 'significance_info.pickle'), 'wb') as f:
 				pickle.dump(significance, f) 
 
@@ -0,0 +1,208 @@
+import os
+import json
+import numpy as np
+
+
+class SparseGraph():
+    """
+        Compact weighted directed graph shared by ConceptGraph, DeltaGraph,
+        CausalGraph and EstimateTrails.
+
+        Adjacency is stored in CSR format (indptr, indices) with float32
+        edge weights, nodes in a table with concept name, layer name,
+        description and filter indices (also CSR, filter_indptr). Graph is
+        saved as a directory of .npy files plus nodes.json, so it loads in
+        milliseconds and arrays can be memory mapped.
+
+        indptr       : (nnodes + 1,) int64, edges of node i are
+                        indices[indptr[i]: indptr[i+1]]
+        indices      : (nedges,) int32, target node of each edge
+        weights      : (nedges,) float32, weight of each edge
+        node_info    : list of {'concept_name', 'layer_name',
+                        'filter_idxs', 'description'}
+    """
+
+    def __init__(self, indptr, indices, weights, node_info):
+
+        self.indptr    = indptr
+        self.indices   = indices
+        self.weights   = weights
+        self.names     = [str(info['concept_name']) for info in node_info]
+        self.layers    = [str(info.get('layer_name', '')) for info in node_info]
+        self.descriptions = [str(info.get('description', '')) for info in node_info]
+
+        filter_idxs = [np.asarray(info.get('filter_idxs', []), dtype='int32').ravel() for info in node_info]
+        self.filter_indptr = np.concatenate([[0], np.cumsum([len(idxs) for idxs in filter_idxs])]).astype('int64')
+        self.filter_idxs   = np.concatenate(filter_idxs + [np.zeros(0, dtype='int32')]).astype('int32')
+
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+
+    @classmethod
+    def from_edges(cls, node_info, edges):
+        """
+            graph from list of edges
+
+            node_info : list of {'concept_name', 'layer_name',
+                            'filter_idxs', 'description'}
+            edges     : list of (source, target, weight), source and target
+                            are node indices or concept names
+        """
+        index = {str(info['concept_name']): i for i, info in enumerate(node_info)}
+        src = np.array([index.get(str(e[0]), e[0]) for e in edges], dtype='int64')
+        dst = np.array([index.get(str(e[1]), e[1]) for e in edges], dtype='int64')
+        wts = np.array([e[2] for e in edges], dtype=np.float32)
+
+        order = np.lexsort((dst, src))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength = len(node_info)))]).astype('int64')
+        return cls(indptr, dst[order].astype('int32'), wts[order], node_info)
+
+
+    @classmethod
+    def from_dense(cls, node_info, adj_matrix, threshold=None):
+        """
+            graph from dense adjacency matrix, only nonzero entries
+            (or entries above threshold) are kept
+
+            node_info : list of {'concept_name', 'layer_name',
+                            'filter_idxs', 'description'}
+            adj_matrix: (nnodes x nnodes) array or nested list, entry (i, j)
+                            is weight of edge i -> j
+            threshold : minimum weight of an edge
+        """
+        adj_matrix = np.asarray(adj_matrix, dtype=np.float32)
+        keep = adj_matrix > threshold if threshold is not None else adj_matrix != 0
+        src, dst = np.nonzero(keep)
+        indptr = np.concatenate([[0], np.cumsum(keep.sum(axis=1))]).astype('int64')
+        return cls(indptr, dst.astype('int32'), adj_matrix[src, dst], node_info)
+
+
+    @property
+    def nnodes(self):
+        return len(self.names)
+
+
+    @property
+    def nedges(self):
+        return len(self.indices)
+
+
+    def node_index(self, name):
+        """
+            index of node with given concept name
+        """
+        return self._index[str(name)]
+
+
+    def node_info(self, node):
+        """
+            node table entry of a node
+
+            node: node index or concept name
+        """
+        i = node if isinstance(node, (int, np.integer)) else self.node_index(node)
+        return {'concept_name': self.names[i],
+                'layer_name': self.layers[i],
+                'filter_idxs': self.filter_idxs[self.filter_indptr[i]: self.filter_indptr[i + 1]],
+                'description': self.descriptions[i]}
+
+
+    def neighbours(self, node):
+        """
+            children of a node and weights of corresponding edges
+
+            node: node index or concept name
+        """
+        i = node if isinstance(node, (int, np.integer)) else self.node_index(node)
+        st, en = self.indptr[i], self.indptr[i + 1]
+        return self.indices[st: en], self.weights[st: en]
+
+
+    def edge_weight(self, source, target):
+        """
+            weight of edge source -> target, None if edge does not exist
+        """
+        children, weights = self.neighbours(source)
+        target = target if isinstance(target, (int, np.integer)) else self.node_index(target)
+        match = np.nonzero(children == target)[0]
+        return float(weights[match[0]]) if len(match) else None
+
+
+    def to_dense(self):
+        """
+            dense adjacency matrix (nnodes x nnodes)
+        """
+        adj_matrix = np.zeros((self.nnodes, self.nnodes), dtype=np.float32)
+        src = np.repeat(np.arange(self.nnodes), np.diff(self.indptr))
+        adj_matrix[src, self.indices] = self.weights
+        return adj_matrix
+
+
+    def save(self, path):
+        """
+            saves graph in given directory
+
+            path: directory path
+        """
+        os.makedirs(path, exist_ok = True)
+        for name in ['indptr', 'indices', 'weights', 'filter_indptr', 'filter_idxs']:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'nodes.json'), 'w') as f:
+            json.dump({'concept_name': self.names,
+                        'layer_name': self.layers,
+                        'description': self.descriptions}, f)
+
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+            loads graph saved with save
+
+            path     : directory path
+            mmap_mode: passed to np.load, for example 'r' to memory map arrays
+        """
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode = mmap_mode)
+                    for name in ['indptr', 'indices', 'weights', 'filter_indptr', 'filter_idxs']}
+        with open(os.path.join(path, 'nodes.json'), 'r') as f:
+            nodes = json.load(f)
+
+        graph = cls.__new__(cls)
+        for name, array in arrays.items():
+            setattr(graph, name, array)
+        graph.names        = nodes['concept_name']
+        graph.layers       = nodes['layer_name']
+        graph.descriptions = nodes['description']
+        graph._index = {name: i for i, name in enumerate(graph.names)}
+        return graph
+
+
+    @classmethod
+    def exists(cls, path):
+        """
+            True if a graph is saved in given directory
+        """
+        return os.path.exists(os.path.join(path, 'nodes.json'))
+
+
+    def paths(self, start, end):
+        """
+            all directed paths from start node to end node,
+            each path is a list of node indices
+
+            start: node index or concept name
+            end  : node index or concept name
+        """
+        start = start if isinstance(start, (int, np.integer)) else self.node_index(start)
+        end   = end if isinstance(end, (int, np.integer)) else self.node_index(end)
+
+        paths = []
+        stack = [[start]]
+        while len(stack):
+            path = stack.pop()
+            if path[-1] == end:
+                paths.append(path)
+                continue
+            for child in self.neighbours(path[-1])[0][::-1]:
+                if not child in path:
+                    stack.append(path + [int(child)])
+        return paths
@@ -7,12 +7,14 @@ import os
 import pdb
 import cv2 
 import pickle
+import hashlib
 from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
 
 import pandas as pd
 from ..helpers.utils import *
 from ..clusters.concept import ConceptIdentification
+from .sparse import SparseGraph
 
 from keras.models import Model
 
@@ -20,6 +22,97 @@ from pgm.helpers.trails import findTrails
 from pgm.helpers.common import Node
 from pgm.representation.LinkedListBN import Graph
 
+class TrailIndex(object):
+    r"""
+    Trail index of a SparseGraph, built once per graph.
+
+    Reachability between every pair of nodes is precomputed, so trail
+    enumeration never explores a branch which can not reach the end node.
+    Trails from a node to an end node are memoized, so queries with many 
+    (start, end) pairs share their common suffixes.
+
+    graph: SparseGraph
+    """
+    def __init__(self, graph):
+        self.graph     = graph
+        self.reachable = self._reachability_()
+        self.acyclic   = not np.any(np.diag(self.reachable))
+        self._suffixes = {}
+
+
+    def _reachability_(self):
+        r"""
+        boolean matrix, (i, j) is True if j can be reached from i
+        """
+        n = self.graph.nnodes
+        adjacency = np.zeros((n, n), dtype=bool)
+        src = np.repeat(np.arange(n), np.diff(self.graph.indptr))
+        adjacency[src, np.asarray(self.graph.indices)] = True
+
+        # topological order (Kahn), children before parents in reverse
+        indegree = adjacency.sum(axis=0)
+        order = list(np.nonzero(indegree == 0)[0])
+        for node in order:
+            for child in np.nonzero(adjacency[node])[0]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    order.append(child)
+
+        if len(order) == n:
+            reachable = adjacency.copy()
+            for node in order[::-1]:
+                children = np.nonzero(adjacency[node])[0]
+                if len(children):
+                    reachable[node] |= np.any(reachable[children], axis=0)
+            return reachable
+
+        # cyclic graph, transitive closure by repeated squaring
+        reachable = adjacency.copy()
+        while True:
+            closure = reachable | (np.dot(reachable.astype('int64'), reachable.astype('int64')) > 0)
+            if np.array_equal(closure, reachable):
+                return reachable
+            reachable = closure
+
+
+    def _suffix_trails_(self, node, end):
+        r"""
+        memoized trails from node to end, as tuples of node indices
+        """
+        key = (node, end)
+        if key in self._suffixes:
+            return self._suffixes[key]
+
+        if node == end:
+            suffixes = [(end,)]
+        else:
+            suffixes = []
+            for child in self.graph.neighbours(node)[0]:
+                child = int(child)
+                if child == end or self.reachable[child, end]:
+                    suffixes.extend([(node,) + suffix for suffix in self._suffix_trails_(child, end)])
+
+        self._suffixes[key] = suffixes
+        return suffixes
+
+
+    def trails(self, start, end):
+        r"""
+        all trails from start node to end node, as lists of node indices
+
+        start: node index or concept name
+        end  : node index or concept name
+        """
+        start = start if isinstance(start, (int, np.integer)) else self.graph.node_index(start)
+        end   = end if isinstance(end, (int, np.integer)) else self.graph.node_index(end)
+
+        if not self.acyclic:
+            return self.graph.paths(start, end)
+        if not (start == end or self.reachable[start, end]):
+            return []
+        return [list(trail) for trail in self._suffix_trails_(int(start), int(end))]
+
+
 class EstimateTrails(object):
     r"""
     """
@@ -30,6 +123,8 @@ class EstimateTrails(object):
             metric      : metric to compare prediction with gt, for example dice, CE
             layer_name  : name of the layer which needs to be ablated
             test_img    : test image used for ablation
+            graph       : pgm graph or SparseGraph
+            root_node   : root node of pgm graph (unused for SparseGraph)
         """     
 
         self.model      = model
@@ -40,6 +135,10 @@ class EstimateTrails(object):
         self.classinfo  = classinfo
         self.noutputs   = len(self.model.outputs)
         self.identifier = ConceptIdentification(self.model, self.weights, self.metric)
+
+        self.index      = TrailIndex(graph) if isinstance(graph, SparseGraph) else None
+        self._trails    = {}
+        self._concept_imgs = {}
             
     def get_layer_idx(self, layer_name):
         r"""
@@ -49,6 +148,39 @@ class EstimateTrails(object):
                 return idx
             
     
+    def _find_trails_(self, start_node, end_node):
+        r"""
+        all trails between start_node and end_node, as lists of
+        (node name, node info)
+        """
+        key = (start_node, end_node)
+        if key in self._trails:
+            return self._trails[key]
+
+        if self.index is not None:
+            ftrails = [[(self.graph.names[node], self.graph.node_info(node)) for node in path]
+                        for path in self.index.trails(start_node, end_node)]
+        else:
+            ftrails = findTrails(self.root_node, start_node, end_node)
+            ftrails = [[(node.name, node.info) for node in ntrail] for ntrail in ftrails.trails]
+
+        self._trails[key] = ftrails
+        return ftrails
+
+
+    def _concept_image_(self, name, info, image):
+        r"""
+        visualization of a concept, computed once per node and image
+        """
+        key = (name, hashlib.sha1(np.ascontiguousarray(image)).hexdigest())
+        if not key in self._concept_imgs:
+            self._concept_imgs[key] = self.identifier.check_robustness(info, 
+                                                       test_img = image,
+                                                       save_path = None,
+                                                       nmontecarlo = 1)
+        return self._concept_imgs[key]
+
+
     def trails(self, start_node, end_node, image=None, gt=None, visual=True, save_path=None):
         r"""
         """
@@ -56,40 +188,38 @@ class EstimateTrails(object):
             if (image.all() and gt.all()):
                 raise ValueError("improper argument fot test_img or test_gt")
                 
-        ftrails = findTrails(self.root_node, start_node, end_node)
+        ftrails = self._find_trails_(start_node, end_node)
         trails = []
         trailsdescription = []
         visualtrails = []
 
-        for trailidx, ntrail in enumerate(ftrails.trails):
+        for trailidx, ntrail in enumerate(ftrails):
             trail = ''
             traildescription = ''
             concept_imgs = []
             
-            for node in ntrail:
+            for name, info in ntrail:
 
-                if node.name == end_node:
-                    trail += '  ({})  '.format(node.name)
-                    traildescription += '  ({})  '.format(node.info['description'])
+                if name == end_node:
+                    trail += '  ({})  '.format(name)
+                    traildescription += '  ({})  '.format(info['description'])
                 else:
-                    trail += '  ({})  ->'.format(node.name)
-                    traildescription += '  ({})  ->'.format(node.info['description'])
+                    trail += '  ({})  ->'.format(name)
+                    traildescription += '  ({})  ->'.format(info['description'])
 
 
                 if visual:
-                    if node.info['concept_name'] == 'Input Image':
+                    if info['concept_name'] == 'Input Image' or info['layer_name'] == 'Placeholder':
                         concept_imgs.append(image)
                     else:
-                        concept_imgs.append(self.identifier.check_robustness(node.info, 
-                                                       test_img = image,
-                                                       save_path = None,
-                                                       nmontecarlo = 1))
+                        concept_imgs.append(self._concept_image_(name, info, image))
             trails.append(trail)
             trailsdescription.append(traildescription)
             visualtrails.append(concept_imgs)
             print ("[INFO: BioExp Trails]" + "="*5 + " New trail " + "="*5)
             print (trail)
             print (traildescription)
+            plt.clf()
             for i, cimg in enumerate(concept_imgs):
                 plt.subplot(1, len(concept_imgs), i+1)
                 plt.imshow(np.squeeze(cimg), cmap='jet', vmin=0, vmax=1)
@@ -103,5 +233,24 @@ class EstimateTrails(object):
                 else:
                     plt.show()
                 
-                return trails, trailsdescription, visualtrails
-            return trails, trailsdescription
\ No newline at end of file
+        if visual:
+            return trails, trailsdescription, visualtrails
+        return trails, trailsdescription
+
+
+    def query(self, pairs, image=None, gt=None, visual=True, save_path=None):
+        r"""
+        trails for many (start_node, end_node) pairs, trail enumeration
+        and concept visualizations are shared among all the pairs
+
+        pairs: list of (start_node, end_node)
+
+        returns dict with (start_node, end_node) as key and output
+        of trails as value
+        """
+        return {(start_node, end_node): self.trails(start_node, end_node, 
+                                                    image = image, 
+                                                    gt = gt, 
+                                                    visual = visual, 
+                                                    save_path = save_path)
+                    for start_node, end_node in pairs}
\ No newline at end of file
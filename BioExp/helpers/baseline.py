@@ -0,0 +1,65 @@
+import os
+import numpy as np
+from collections import OrderedDict
+
+
+class BaselineCache():
+    """
+        Cache of unablated (baseline) model predictions.
+
+        Baseline prediction of an image does not depend on the ablated
+        node, so it is computed once per (weights file, input path) and
+        shared by every link and significance test. Modification time of
+        the weights file is a part of the key, so retrained weights are
+        never served stale predictions. Least recently used entries are
+        evicted beyond max_entries.
+
+        max_entries : maximum number of cached predictions
+    """
+
+    def __init__(self, max_entries=1024):
+
+        self.max_entries = max_entries
+        self._cache      = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._cache)
+
+
+    def _key_(self, weights_pth, input_path):
+        weights_pth = os.path.realpath(weights_pth)
+        return (weights_pth, os.path.getmtime(weights_pth), os.path.realpath(input_path))
+
+
+    def predict(self, model, weights_pth, input_path, input_):
+        """
+            baseline prediction of an image, model is evaluated only
+            on cache miss
+
+            model      : keras model loaded with weights_pth
+            weights_pth: saved weights path (str)
+            input_path : path of the input image, used as key
+            input_     : image (H x W x C)
+        """
+        key = self._key_(weights_pth, input_path)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        prediction = np.squeeze(model.predict(input_[None, ...]))
+        self._cache[key] = prediction
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last = False)
+        return prediction
+
+
+    def clear(self):
+        """
+            removes all the cached predictions
+        """
+        self._cache.clear()
+
+
+# shared by DeltaGraph and SignificanceTester unless a cache is provided
+baseline_cache = BaselineCache()
@@ -0,0 +1,101 @@
+import os
+import numpy as np
+from keras.models import Model
+from .utils import load_dataset
+from .store import ActivationStore
+
+
+class FeatureExtractor():
+    """
+        Multi-output feature extractor, taps any set of layers of a keras
+        model in a single forward pass.
+
+        Consumers (Dissector, ConceptGraph, ConceptIdentification) share one
+        extractor and take their own slice of the outputs, so activations of
+        all the tapped layers cost one forward pass per image instead of one
+        per layer. Layers share weights with the given model.
+
+        model       : keras model initialized with trained weights
+        layer_names : names of the layers to tap
+    """
+
+    def __init__(self, model, layer_names):
+
+        self.model       = model
+        self.layer_names = []
+        for layer_name in layer_names:
+            if not layer_name in self.layer_names:
+                self.layer_names.append(layer_name)
+
+        outputs = [model.get_layer(layer_name).output for layer_name in self.layer_names]
+        self.extractor = Model(inputs=model.input, outputs=outputs)
+
+
+    def predict(self, images, batch_size=8):
+        """
+            activations of all the tapped layers
+
+            images    : images in batch format (N x H x W x C)
+            batch_size: batch size for forward pass
+
+            returns dict with layer name as key and activations
+            (N x ...) as value
+        """
+        outputs = self.extractor.predict(images, batch_size = batch_size)
+        if len(self.layer_names) == 1:
+            outputs = [outputs]
+        return dict(zip(self.layer_names, outputs))
+
+
+    def extract_dataset(self, dataset_path, loader, max_samples=-1, batch_size=8):
+        """
+            generator over activations of a dataset, batch by batch
+
+            dataset_path: root directory of dataset
+            loader      : custom loader which takes image path and mask path
+                            and returns both image and corresponding gt
+            max_samples : maximum number of samples to load
+                            if -1 loads all images in provided root dir
+            batch_size  : batch size for forward pass
+        """
+        batch = []
+        for i, (input_, label_) in enumerate(load_dataset(dataset_path, loader, max_samples = max_samples)):
+            batch.append(input_)
+            if len(batch) == batch_size:
+                print ("[INFO: BioExp] Slice no {} -- Working on {} layers".format(i, len(self.layer_names)))
+                yield self.predict(np.array(batch), batch_size = batch_size)
+                batch = []
+        if len(batch):
+            yield self.predict(np.array(batch), batch_size = batch_size)
+
+
+    def get_activation_stores(self, dataset_path, loader, root, max_samples=500, batch_size=8):
+        """
+            activation store of every tapped layer, stores which are not
+            complete are filled together in a single pass over the dataset
+
+            dataset_path: root directory of dataset
+            loader      : custom loader which takes image path and mask path
+                            and returns both image and corresponding gt
+            root        : root directory of activation stores
+            max_samples : maximum number of samples to load
+            batch_size  : batch size for forward pass
+
+            returns dict with layer name as key and ActivationStore as value
+        """
+        stores  = {layer_name: ActivationStore(root, layer_name) for layer_name in self.layer_names}
+        pending = [layer_name for layer_name in self.layer_names if not stores[layer_name].complete]
+        if not len(pending):
+            return stores
+
+        for layer_name in pending:
+            stores[layer_name].reset()
+
+        for outputs in self.extract_dataset(dataset_path, loader, max_samples, batch_size):
+            for layer_name in pending:
+                stores[layer_name].append(outputs[layer_name])
+
+        for layer_name in pending:
+            stores[layer_name].close()
+
+        return stores
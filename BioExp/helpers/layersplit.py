@@ -0,0 +1,154 @@
+import numpy as np
+import keras.backend as K
+
+
+def get_ablated_value(layer):
+    """
+        value of ablated channel in layer output, zeroing kernel and bias
+        of a filter results in activation(0) in its output channel
+
+        layer : keras layer
+    """
+    activation = getattr(layer, 'activation', None)
+    if activation is None:
+        return 0.
+    try:
+        return float(K.eval(activation(K.constant(0.))))
+    except:
+        return 0.
+
+
+class LayerSplit():
+    """
+        Splits a keras model at an intermediate layer into an upstream
+        and a downstream half.
+
+        Upstream half maps model inputs to the frontier, i.e. all the tensors
+        computed at or before the split layer which are consumed after it
+        (layer output and skip connections). Downstream half maps the frontier
+        to the outputs. Ablating filters of the split layer does not change the
+        upstream activations, so they can be computed once per image and only
+        downstream half needs to be evaluated for every ablation.
+
+        model      : keras model initialized with trained weights
+        layer_name : name of the layer at which model needs to be split
+        outputs    : tensors evaluated by downstream half,
+                        model outputs if None
+    """
+
+    def __init__(self, model, layer_name, outputs=None):
+
+        self.model      = model
+        self.layer_name = layer_name
+        self.layer_idx  = [layer.name for layer in model.layers].index(layer_name)
+        self.layer      = model.layers[self.layer_idx]
+        self.outputs    = model.outputs if outputs is None else self._to_list_(outputs)
+
+        self.frontier   = self._get_frontier_()
+        self.output_idx = [tensor.name for tensor in self.frontier].index(self.layer.get_output_at(0).name)
+        self.nchannels  = int(self.layer.get_output_at(0).shape[-1])
+        self.ablated_value = get_ablated_value(self.layer)
+
+        self._upstream   = K.function(self._inputs_(model.inputs), self.frontier)
+        self._downstream = K.function(self._inputs_(self.frontier), self.outputs)
+
+
+    def _to_list_(self, x):
+        return x if isinstance(x, list) else [x]
+
+
+    def _inputs_(self, inputs):
+        """
+            appends learning phase to the inputs of keras function if
+            model behaves differently in training and testing
+        """
+        if self.model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+            return inputs + [K.learning_phase()]
+        return inputs
+
+
+    def _take_(self, array, st, nsamples, batch_size):
+        """
+            batch of array starting at st, arrays with single sample
+            are broadcasted to the batch
+        """
+        if len(array) == 1:
+            return np.repeat(array, min(batch_size, nsamples - st), axis=0)
+        return array[st: st + batch_size]
+
+
+    def _call_(self, function, values, batch_size, mask=None):
+        """
+            evaluates keras function in batches, channels of split layer 
+            output (if fed) are ablated wherever mask is 0
+        """
+        nsamples = max([len(value) for value in values] + ([] if mask is None else [len(mask)]))
+        outputs = []
+        for st in range(0, nsamples, batch_size):
+            batch = [self._take_(value, st, nsamples, batch_size) for value in values]
+            if mask is not None:
+                bmask = self._take_(mask, st, nsamples, batch_size)
+                batch[self.output_idx] = batch[self.output_idx]*bmask + self.ablated_value*(1. - bmask)
+            if len(function.inputs) > len(batch):
+                batch.append(0)
+            outputs.append(function(batch))
+        return [np.concatenate([output[i] for output in outputs], axis=0) for i in range(len(outputs[0]))]
+
+
+    def _get_frontier_(self):
+        """
+            tensors produced at or before split layer and consumed after it
+        """
+        produced = {}
+        for layer in self.model.layers[:self.layer_idx + 1]:
+            for tensor in self._to_list_(layer.get_output_at(0)):
+                produced[tensor.name] = tensor
+
+        frontier = [self.layer.get_output_at(0)]
+        consumed = []
+        for layer in self.model.layers[self.layer_idx + 1:]:
+            consumed.extend(self._to_list_(layer.get_input_at(0)))
+        consumed.extend(self.outputs)
+
+        for tensor in consumed:
+            if (tensor.name in produced) and not (tensor.name in [t.name for t in frontier]):
+                frontier.append(tensor)
+        return frontier
+
+
+    def get_mask(self, filter_idxs):
+        """
+            channel mask for split layer output with filter_idxs ablated
+
+            filter_idxs: list of filter indices to ablate
+        """
+        mask = np.ones(self.nchannels, dtype=np.float32)
+        mask[np.array(filter_idxs, dtype='int64')] = 0
+        return mask
+
+
+    def upstream(self, images, batch_size=8):
+        """
+            frontier activations for given images
+
+            images    : images in batch format (N x H x W x C)
+            batch_size: batch size for forward pass
+        """
+        return self._call_(self._upstream, self._to_list_(images), batch_size)
+
+
+    def downstream(self, frontier, mask=None, batch_size=8):
+        """
+            evaluates outputs from frontier activations, channels of
+            split layer output are ablated wherever mask is 0
+
+            frontier  : frontier activations (list of arrays, N x ...),
+                            N can be 1 to share activations among all masks
+            mask      : channel mask (C,) shared by all samples or
+                            (M x C) one per sample, no ablation if None
+            batch_size: batch size for forward pass
+        """
+        if mask is not None:
+            mask = np.array(mask, dtype=np.float32)
+            mask = mask.reshape((-1,) + (1,)*(frontier[self.output_idx].ndim - 2) + (self.nchannels,))
+        return self._call_(self._downstream, list(frontier), batch_size, mask=mask)
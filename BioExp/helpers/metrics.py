@@ -1,6 +1,7 @@
 import numpy as np
 import keras.backend as K
 import tensorflow as tf
+from .losses import dice_label_coef
 
 def dice(y_true, y_pred):
     #computes the dice score on two tensors
@@ -99,3 +100,81 @@ def dice_label_metric(y_true, y_pred, label):
 	return dice_en
 
 
+
+
+def confusion_histogram(gts, preds, nclasses):
+    """
+        confusion histograms of a batch of label maps, computed
+        with a single bincount
+
+        gts     : ground truth label maps (N x H x W) or (1 x H x W),
+                    single ground truth is shared by all predictions
+        preds   : predicted label maps (N x H x W)
+        nclasses: number of labels
+        return  : (N x nclasses x nclasses), [n, i, j] counts pixels 
+                    with gt label i and predicted label j in n-th pair
+    """
+    preds = np.asarray(preds).astype('int64')
+    gts   = np.asarray(gts).astype('int64')
+    npreds = len(preds)
+    codes = gts.reshape(len(gts), -1)*nclasses + preds.reshape(npreds, -1)
+    codes = codes + (np.arange(npreds)*nclasses*nclasses)[:, None]
+    hist  = np.bincount(codes.ravel(), minlength = npreds*nclasses*nclasses)
+    return hist.reshape(npreds, nclasses, nclasses)
+
+
+def class_dice(hist, classinfo, smooth=1e-3):
+    """
+        dice score of every class group from confusion histograms,
+        same as dice_label_coef for each group
+
+        hist     : confusion histograms (N x nclasses x nclasses)
+        classinfo: class groups, {'whole': (1,2,3), 'ET': (3,)}
+        smooth   : smoothing term
+        return   : scores (N x len(classinfo)), columns in classinfo order
+    """
+    nclasses = hist.shape[-1]
+    members = np.zeros((nclasses, len(classinfo)))
+    for i, class_ in enumerate(classinfo.keys()):
+        members[np.array(classinfo[class_], dtype='int64'), i] = 1
+
+    intersection = np.einsum('nij,ik,jk->nk', hist, members, members)
+    sum_r = np.dot(hist.sum(axis = 2), members)
+    sum_p = np.dot(hist.sum(axis = 1), members)
+    return (2. * intersection + smooth) / (sum_p + sum_r + smooth)
+
+
+def batch_dice(gts, preds, classinfo, nclasses=None):
+    """
+        vectorized dice for all the class groups on a batch of label maps
+
+        gts      : ground truth label maps (N x H x W) or (1 x H x W)
+        preds    : predicted label maps (N x H x W)
+        classinfo: class groups, {'whole': (1,2,3), 'ET': (3,)}
+        nclasses : number of labels, inferred if None
+        return   : scores (N x len(classinfo)), columns in classinfo order
+    """
+    if nclasses is None:
+        nclasses = int(max(np.max(gts), np.max(preds), 
+                            max([max(labels) for labels in classinfo.values()]))) + 1
+    return class_dice(confusion_histogram(gts, preds, nclasses), classinfo)
+
+
+def class_scores(metric, gts, preds, classinfo, nclasses=None):
+    """
+        scores for all the class groups on a batch of label maps,
+        uses vectorized dice if metric is None or dice_label_coef
+        else metric(gt, pred, labels) is evaluated for every pair and group
+
+        metric   : metric to compare prediction with gt
+        gts      : ground truth label maps (N x H x W) or (1 x H x W)
+        preds    : predicted label maps (N x H x W)
+        classinfo: class groups, {'whole': (1,2,3), 'ET': (3,)}
+        nclasses : number of labels, inferred if None
+        return   : scores (N x len(classinfo)), columns in classinfo order
+    """
+    if (metric is None) or (metric is dice_label_coef):
+        return batch_dice(gts, preds, classinfo, nclasses)
+
+    return np.array([[metric(gts[0 if len(gts) == 1 else n], preds[n], classinfo[class_]) 
+                        for class_ in classinfo.keys()] for n in range(len(preds))])
@@ -0,0 +1,216 @@
+import numpy as np
+
+
+class QuantileSketch():
+    """
+        Streaming per-cell quantile estimator for activation maps.
+
+        Every cell (each pixel of each channel) keeps a histogram of nbins
+        counts, bin edges are shared by all the cells of a channel. Range of
+        a channel is initialized from the first batch and doubled, by merging
+        pairs of adjacent bins, whenever a value falls outside of it, so no
+        value is ever clipped. Memory is ncells x nbins counts irrespective
+        of the number of samples seen.
+
+        Error bound: for every cell of channel c
+            |estimate - np.percentile(samples, q)| <= (hi_c - lo_c) / nbins
+        where [lo_c, hi_c] is the final range of channel c (see error_bound).
+        np.percentile interpolates between the order statistics at ranks
+        floor(k) and ceil(k), k = q/100 (n - 1); each of these lies in a known
+        bin, the estimate interpolates between points of the same two bins
+        with the same weights, so it is off by at most one bin width.
+
+        nbins : number of bins per cell (even)
+    """
+
+    def __init__(self, nbins=32):
+
+        if nbins % 2:
+            raise ValueError("nbins should be even, {} was provided".format(nbins))
+
+        self.nbins    = nbins
+        self.nsamples = 0
+        self.counts   = None
+        self.lo       = None
+        self.hi       = None
+
+
+    def _initialize_(self, batch):
+        """
+            sets channel ranges from first batch
+        """
+        channels = batch.reshape(-1, batch.shape[-1])
+        self.lo = channels.min(axis=0).astype(np.float64)
+        self.hi = channels.max(axis=0).astype(np.float64)
+        eps = np.maximum(1e-6, 1e-6*np.abs(self.lo))
+        self.hi = np.maximum(self.hi, self.lo + eps)
+        self.counts = np.zeros(batch.shape[1:] + (self.nbins,), dtype=np.uint32)
+
+
+    def _expand_(self, channel, upward):
+        """
+            doubles the range of a channel by merging adjacent bins
+
+            channel: channel index
+            upward : expands range above hi if True else below lo
+        """
+        half   = self.nbins // 2
+        counts = self.counts[..., channel, :]
+        merged = counts.reshape(counts.shape[:-1] + (half, 2)).sum(axis=-1)
+        width  = self.hi[channel] - self.lo[channel]
+
+        counts[...] = 0
+        if upward:
+            counts[..., :half] = merged
+            self.hi[channel] = self.lo[channel] + 2*width
+        else:
+            counts[..., half:] = merged
+            self.lo[channel] = self.hi[channel] - 2*width
+
+
+    def update(self, batch):
+        """
+            adds a batch of activation maps to the sketch
+
+            batch: activation maps (N x ... x C)
+        """
+        batch = np.asarray(batch)
+        if self.counts is None:
+            self._initialize_(batch)
+        elif not batch.shape[1:] == self.counts.shape[:-1]:
+            raise ValueError("Shape mismatch, sketch: {}, given: {}".format(self.counts.shape[:-1], batch.shape[1:]))
+
+        channels = batch.reshape(-1, batch.shape[-1])
+        vmin, vmax = channels.min(axis=0), channels.max(axis=0)
+        for c in range(len(self.lo)):
+            while vmax[c] > self.hi[c]:
+                self._expand_(c, upward=True)
+            while vmin[c] < self.lo[c]:
+                self._expand_(c, upward=False)
+
+        width = (self.hi - self.lo)/self.nbins
+        flat  = self.counts.reshape(-1)
+        cells = np.arange(flat.size // self.nbins)*self.nbins
+
+        # one sample at a time, so that every cell is indexed once per update
+        for sample in batch:
+            bins = np.floor((sample - self.lo)/width).astype('int64')
+            bins = np.clip(bins, 0, self.nbins - 1)
+            flat[cells + bins.reshape(-1)] += 1
+
+        self.nsamples += len(batch)
+
+
+    def error_bound(self):
+        """
+            maximum absolute error of the estimated percentiles for each channel
+        """
+        return (self.hi - self.lo)/self.nbins
+
+
+    def _rank_value_(self, counts, cumsum, rank, lo, width):
+        """
+            value of the order statistic at given rank, interpolated within
+            the bin containing it
+        """
+        bins  = np.sum(cumsum <= rank, axis=-1)
+        prev  = np.take_along_axis(cumsum, bins[..., None], axis=-1)[..., 0] - \
+                    np.take_along_axis(counts, bins[..., None], axis=-1)[..., 0]
+        count = np.take_along_axis(counts, bins[..., None], axis=-1)[..., 0]
+        within = (rank - prev + 0.5)/np.maximum(count, 1)
+        return lo + (bins + within)*width
+
+
+    def percentile(self, percentile):
+        """
+            estimated percentile for every cell
+
+            percentile: value between (0, 100)
+        """
+        if not self.nsamples:
+            raise ValueError("Sketch is empty")
+
+        k = percentile/100.*(self.nsamples - 1)
+        r1, r2 = int(np.floor(k)), int(np.ceil(k))
+        frac = k - r1
+
+        width = (self.hi - self.lo)/self.nbins
+        maps  = np.zeros(self.counts.shape[:-1])
+        for c in range(len(self.lo)):
+            counts = self.counts[..., c, :].astype('int64')
+            cumsum = np.cumsum(counts, axis=-1)
+            v1 = self._rank_value_(counts, cumsum, r1, self.lo[c], width[c])
+            v2 = self._rank_value_(counts, cumsum, r2, self.lo[c], width[c])
+            maps[..., c] = v1 + frac*(v2 - v1)
+        return maps
+
+
+class JointHistogram():
+    """
+        Streaming joint histograms of paired columns, used to estimate
+        mutual information over arbitrarily many samples.
+
+        Every column pair (x_d, y_d) keeps a dense bins x bins joint
+        histogram of already binned values, so memory is fixed at
+        ncolumns x bins^2 counts irrespective of the number of samples;
+        columns are meant to be few (for example channels, with spatial
+        positions pooled as samples), not every activation of a layer.
+        Bin edges have to be fixed before streaming (for example from a
+        calibration pass), with the range of all the samples the result
+        is the same as a single np.histogram2d over all of them.
+        Marginals are sums of the joint histogram.
+
+        ncolumns : number of column pairs
+        bins     : number of bins per axis
+    """
+
+    def __init__(self, ncolumns, bins=100):
+
+        self.ncolumns = ncolumns
+        self.bins     = bins
+        self.nsamples = 0
+        self.counts   = np.zeros((ncolumns, bins*bins), dtype=np.int64)
+
+
+    def update(self, bx, by):
+        """
+            adds a batch of paired, binned samples to the histograms
+
+            bx: bin indices of x, integers in [0, bins) (N x ncolumns)
+            by: bin indices of y, same shape as bx
+        """
+        bx = np.asarray(bx, dtype='int64').reshape(len(bx), -1)
+        by = np.asarray(by, dtype='int64').reshape(len(by), -1)
+        if not bx.shape == by.shape:
+            raise ValueError("Shape mismatch, x: {}, y: {}".format(bx.shape, by.shape))
+        if not bx.shape[1] == self.ncolumns:
+            raise ValueError("Shape mismatch, histogram: {}, given: {}".format(self.ncolumns, bx.shape[1]))
+
+        keys = (np.arange(self.ncolumns)*self.bins*self.bins + bx*self.bins + by).ravel()
+        self.counts += np.bincount(keys, minlength = self.counts.size).reshape(self.counts.shape)
+        self.nsamples += len(bx)
+
+
+    def _entropy_(self, counts, eps):
+        """
+            entropy of each row of counts (ncolumns x ncells)
+        """
+        cols, cells = np.nonzero(counts)
+        p = counts[cols, cells]/float(self.nsamples)
+        return np.bincount(cols, weights = -p*np.log2(p), minlength = len(counts)) + eps
+
+
+    def nmi(self, eps=np.finfo(np.float32).eps):
+        """
+            normalized mutual information of every column
+            NMI = 2*I(X,Y)/(H(X) + H(Y))
+        """
+        if not self.nsamples:
+            raise ValueError("Histogram is empty")
+
+        joint = self.counts.reshape(self.ncolumns, self.bins, self.bins)
+        H_XY = self._entropy_(self.counts, eps)
+        H_X  = self._entropy_(joint.sum(axis = 2), eps)
+        H_Y  = self._entropy_(joint.sum(axis = 1), eps)
+
+        return 2.*(H_X + H_Y - H_XY)/(H_X + H_Y)
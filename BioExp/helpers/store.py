@@ -0,0 +1,161 @@
+import os
+import json
+import shutil
+import numpy as np
+
+
+class ActivationStore():
+    """
+        Chunked on-disk store of activation maps, one directory per layer.
+
+        Activations are appended as they are computed and written to disk in
+        chunks of chunk_size samples (one .npy file per chunk). Chunks are
+        memory mapped while reading, so the whole stack is never resident in
+        memory and statistics like percentiles are computed block by block.
+        Same store can be reused by Dissector, ConceptGraph and
+        ConceptIdentification as long as they share the root directory.
+
+        root      : root directory of the store
+        name      : name of the store, for example layer name
+        chunk_size: number of samples per chunk
+    """
+
+    def __init__(self, root, name, chunk_size=64):
+
+        self.path       = os.path.join(root, name)
+        self.name       = name
+        self.chunk_size = chunk_size
+        self._buffer    = []
+        self.info       = self._read_info_()
+
+
+    def _info_path_(self):
+        return os.path.join(self.path, 'info.json')
+
+
+    def _chunk_path_(self, idx):
+        return os.path.join(self.path, 'chunk_{:05d}.npy'.format(idx))
+
+
+    def _read_info_(self):
+        if os.path.exists(self._info_path_()):
+            with open(self._info_path_(), 'r') as f:
+                return json.load(f)
+        return {'nsamples': 0, 'nchunks': 0, 'shape': None, 'dtype': None, 'complete': False}
+
+
+    def _write_info_(self):
+        with open(self._info_path_(), 'w') as f:
+            json.dump(self.info, f)
+
+
+    @property
+    def complete(self):
+        """
+            True if all the activations were written and store was closed
+        """
+        return self.info['complete']
+
+
+    @property
+    def shape(self):
+        """
+            shape of the full stack (nsamples x ...)
+        """
+        return tuple([self.info['nsamples']] + list(self.info['shape']))
+
+
+    def __len__(self):
+        return self.info['nsamples']
+
+
+    def reset(self):
+        """
+            removes all the stored activations
+        """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self._buffer = []
+        self.info = {'nsamples': 0, 'nchunks': 0, 'shape': None, 'dtype': None, 'complete': False}
+        self._write_info_()
+
+
+    def _flush_(self, force=False):
+        while len(self._buffer) >= self.chunk_size or (force and len(self._buffer)):
+            chunk = np.array(self._buffer[:self.chunk_size])
+            self._buffer = self._buffer[self.chunk_size:]
+
+            np.save(self._chunk_path_(self.info['nchunks']), chunk)
+            self.info['nchunks']  += 1
+            self.info['nsamples'] += len(chunk)
+            self._write_info_()
+
+
+    def append(self, activations):
+        """
+            appends a batch of activations to the store
+
+            activations: activation maps (N x ...)
+        """
+        if self.complete:
+            raise ValueError("Store {} is closed, reset it before appending".format(self.path))
+        if not os.path.exists(self.path):
+            self.reset()
+
+        activations = np.asarray(activations)
+        if self.info['shape'] is None:
+            self.info['shape'] = list(activations.shape[1:])
+            self.info['dtype'] = str(activations.dtype)
+        elif not list(activations.shape[1:]) == self.info['shape']:
+            raise ValueError("Shape mismatch, store: {}, given: {}".format(self.info['shape'], activations.shape[1:]))
+
+        self._buffer.extend(list(activations))
+        self._flush_()
+
+
+    def close(self):
+        """
+            writes remaining activations and marks store as complete
+        """
+        self._flush_(force=True)
+        self.info['complete'] = True
+        self._write_info_()
+
+
+    def chunks(self):
+        """
+            generator over memory mapped chunks
+        """
+        for idx in range(self.info['nchunks']):
+            yield np.load(self._chunk_path_(idx), mmap_mode='r')
+
+
+    def percentile(self, percentile, max_block_bytes=2**28):
+        """
+            exact percentile over the sample axis, computed block by block
+            along the first spatial axis so that at most max_block_bytes of
+            activations are loaded at once
+
+            percentile     : value used for thresholding, range: (0, 100)
+            max_block_bytes: memory budget per block
+        """
+        shape = self.info['shape']
+        if not len(shape):
+            return np.percentile(np.concatenate(list(self.chunks())), percentile, axis=0)
+
+        row_bytes  = len(self)*int(np.prod(shape[1:]))*np.dtype(self.info['dtype']).itemsize
+        block_rows = int(max(1, max_block_bytes // max(1, row_bytes)))
+
+        maps = []
+        for st in range(0, shape[0], block_rows):
+            block = np.concatenate([chunk[:, st: st + block_rows] for chunk in self.chunks()], axis=0)
+            maps.append(np.percentile(block, percentile, axis=0))
+        return np.concatenate(maps, axis=0)
+
+
+    def norm(self):
+        """
+            frobenius norm of the full stack, computed chunk by chunk
+        """
+        return np.sqrt(np.sum([np.sum(np.square(chunk, dtype=np.float64)) for chunk in self.chunks()]))
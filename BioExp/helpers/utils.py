@@ -141,6 +141,25 @@ def load_vol( t1path, t2path, t1cepath, flairpath,
     return test_image
 
 
+def load_dataset(dataset_path, loader, max_samples=-1):
+    """
+        generator over (image, gt) pairs of a dataset
+
+        dataset_path: root directory of dataset
+        loader      : custom loader which takes image path and mask path
+                        and returns both image and corresponding gt
+        max_samples : maximum number of samples to load
+                        if -1 loads all images in provided root dir
+    """
+    input_paths = os.listdir(dataset_path)
+    if not max_samples == -1:
+        input_paths = input_paths[:max_samples]
+
+    for input_path in input_paths:
+        yield loader(os.path.join(dataset_path, input_path), 
+                        os.path.join(dataset_path, input_path).replace('mask', 'label').replace('labels', 'masks'))
+
+
 def load_file( rgbpath, maskpath=None):
     """
         loads rgb image
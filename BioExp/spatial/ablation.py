@@ -3,6 +3,8 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 import os
+import hashlib
+from collections import OrderedDict
 import keras
 import numpy as np
 import tensorflow as tf
@@ -12,6 +14,9 @@ from tqdm import tqdm
 import keras.backend as K
 from keras.utils import np_utils
 from keras.models import load_model
+from ..helpers.layersplit import LayerSplit
+from ..helpers.utils import load_dataset
+from ..helpers.metrics import class_scores
 
 
 class Ablate():
@@ -21,19 +26,22 @@ class Ablate():
 	"""		
 
 
-	def __init__(self, model, weights_pth, metric, layer_name, test_image, gt, classes, nclasses=4, image_name=None):
+	def __init__(self, model, weights_pth, metric, layer_name, test_image=None, gt=None, classes=None, nclasses=4, image_name=None, max_baselines=16):
 		
 		"""
 		model       : keras model architecture (keras.models.Model)
 		weights_pth : saved weights path (str)
                 metric      : metric to compare prediction with gt, for example dice, CE
                 layer_name  : name of the layer which needs to be ablated
-                test_img    : test image used for ablation
+                test_img    : test image used for ablation, can be None 
+				when only ablate_many or ablate_dataset is used
                 gt          : ground truth for comparision
                 classes     : class informatiton which needs to be considered, class label as 
 				key and corresponding required values 
 				in a tuple: {'class1': (1,), 'whole': (1,2,3)}
                 nclasses    : number of unique classes in gt
+                max_baselines: maximum number of images whose upstream activations
+				and outputs are cached, least recently used are evicted
 		"""		
 
 		self.model = model
@@ -56,6 +64,233 @@ class Ablate():
 		self.layer_weights = np.array(self.model.layers[self.layer_idx].get_weights())
 		self.filter_shape = self.layer_weights[0].shape
 
+		self.split = LayerSplit(self.model, self.layer)
+		self.max_baselines = max_baselines
+		self._baseline_cache = OrderedDict()
+
+
+	def _image_key(self, image):
+		"""
+			key used to cache per image results
+		"""
+		return hashlib.sha1(np.ascontiguousarray(image).tobytes()).hexdigest()
+
+
+	def _select_output(self, outputs):
+		"""
+			selects segmentation output (output with nclasses channels)
+			from list of model outputs
+		"""
+		if self.noutputs == 1:
+			return outputs[0]
+		idx = None
+		for ii in range(self.noutputs):
+			if outputs[ii].shape[-1] == self.nclasses:
+				idx = ii
+		if idx is None:
+			raise ValueError("None of the {} model outputs has nclasses = {} channels, output channels: {}".format(self.noutputs, 
+						self.nclasses, [output.shape[-1] for output in outputs]))
+		return outputs[idx]
+
+
+	def _get_baseline(self, image):
+		"""
+			returns cached (upstream activations, unablated outputs) of given image,
+			upstream activations are the inputs to the downstream half of the
+			model split at ablated layer, at most max_baselines images are cached
+
+			image: single image in batch format (1 x H x W x C)
+		"""
+		key = self._image_key(image)
+		if key in self._baseline_cache:
+			self._baseline_cache.move_to_end(key)
+			return self._baseline_cache[key]
+
+		frontier = self.split.upstream(image)
+		baseline = (frontier, self.split.downstream(frontier))
+		self._baseline_cache[key] = baseline
+		while len(self._baseline_cache) > self.max_baselines:
+			self._baseline_cache.popitem(last = False)
+		return baseline
+
+
+	def _get_concepts(self, concepts):
+		"""
+			concept names and channel masks
+
+			concepts: {concept_name: filter_idxs} or list of filter_idxs
+		"""
+		if isinstance(concepts, dict):
+			names   = list(concepts.keys())
+			filters = list(concepts.values())
+		else:
+			names   = list(range(len(concepts)))
+			filters = list(concepts)
+
+		masks = np.array([self.split.get_mask(filter_idxs) for filter_idxs in filters])
+		return names, masks
+
+
+	def _get_scores(self, gt, predictions):
+		"""
+			metric for each class in classinfo, for a batch of predictions
+			of the same image
+
+			gt         : ground truth (H x W)
+			predictions: network outputs (N x H x W x nclasses)
+			Outputs: scores (N x nclass)
+		"""
+		return class_scores(self.metric, np.asarray(gt)[None, ...], 
+					predictions.argmax(axis = -1), self.classinfo)
+
+
+	def _ablate_image(self, frontier, prediction, gt, masks, batch_size):
+		"""
+			scores of unablated and ablated predictions for a single image
+
+			frontier  : upstream activations of the image (batch of 1)
+			prediction: unablated network output (H x W x nclasses)
+			gt        : ground truth (H x W)
+			masks     : channel masks, one for each concept (nconcepts x C)
+			Outputs: actual scores (nclass,), ablated scores (nconcepts x nclass)
+		"""
+		actual  = self._get_scores(gt, prediction[None, ...])[0]
+		ablated = []
+		for st in range(0, len(masks), batch_size):
+			prediction_occluded = self._select_output(self.split.downstream(frontier, 
+											masks[st:st + batch_size], 
+											batch_size=batch_size))
+			ablated.append(self._get_scores(gt, prediction_occluded))
+		return actual, np.concatenate(ablated, axis=0)
+
+
+	def ablate_many(self, concepts, images=None, gts=None, batch_size=8, verbose=1):
+		"""
+		Ablates several concepts of the layer for each image. Baseline prediction
+		is evaluated once per image (and cached), all ablations are then evaluated 
+		in batches by masking the channels of layer output for each concept, 
+		layer weights are not modified.
+
+		Arguments:
+		concepts  : {concept_name: filter_idxs} or list of filter_idxs
+		images    : images in batch format (N x H x W x C), defaults to test_image
+		gts       : ground truths (N x H x W), defaults to gt
+		batch_size: number of ablated predictions made in one forward pass
+		Outputs: A tidy dataframe with one row per (image, concept, class) 
+				with actual and ablated scores
+		"""
+
+		image_names = None
+		if images is None:
+			images = self.test_image
+			gts = np.array(self.gt)[None, ...]
+			image_names = [self.image_name]
+		elif gts is None:
+			raise ValueError("gts are required when images are given")
+		if len(gts) != len(images):
+			raise ValueError("number of gts ({}) does not match number of images ({})".format(len(gts), len(images)))
+		if image_names is None or image_names[0] is None:
+			image_names = list(range(len(images)))
+
+		names, masks = self._get_concepts(concepts)
+		classes = list(self.classinfo.keys())
+
+		dice_json = {'image': [], 'concept': [], 'class': [], 'actual': [], 'ablated': []}
+
+		for n in tqdm(range(len(images)), disable = not verbose):
+			frontier, outputs = self._get_baseline(images[n:n+1])
+			actual, ablated = self._ablate_image(frontier, self._select_output(outputs)[0], 
+								gts[n], masks, batch_size)
+
+			for i in range(len(masks)):
+				for j, class_ in enumerate(classes):
+					dice_json['image'].append(image_names[n])
+					dice_json['concept'].append(names[i])
+					dice_json['class'].append(class_)
+					dice_json['actual'].append(actual[j])
+					dice_json['ablated'].append(ablated[i, j])
+
+		df = pd.DataFrame(dice_json)
+		return df
+
+
+	def ablate_dataset(self, concepts, data, loader=None, max_samples=-1, batch_size=8, verbose=1):
+		"""
+		Ablates several concepts of the layer over a dataset. Images are streamed
+		in batches of batch_size, upstream activations and baseline predictions are
+		evaluated once per batch and the scores are accumulated as running sums,
+		so memory usage does not depend on the number of images.
+
+		Arguments:
+		concepts   : {concept_name: filter_idxs} or list of filter_idxs
+		data       : iterable or generator of (image, gt) pairs, image (H x W x C), 
+				gt (H x W), or dataset root path if loader is given
+		loader     : custom loader which takes image path and mask path 
+				and returns both image and corresponding gt (as in Dissector)
+		max_samples: maximum number of samples used with loader, -1 considers all
+		batch_size : number of images (and ablations) per forward pass
+		Outputs: A dataframe with one row per (concept, class) with mean actual, 
+				ablated scores, mean and std of the drop (actual - ablated)
+		"""
+
+		if loader is not None:
+			data = load_dataset(data, loader, max_samples = max_samples)
+
+		names, masks = self._get_concepts(concepts)
+		classes = list(self.classinfo.keys())
+
+		nsamples  = 0
+		actual_sum  = np.zeros(len(classes))
+		ablated_sum = np.zeros((len(masks), len(classes)))
+		delta_sum   = np.zeros((len(masks), len(classes)))
+		delta_sqsum = np.zeros((len(masks), len(classes)))
+
+		def batches():
+			images, gts = [], []
+			for image, gt in data:
+				images.append(image); gts.append(np.squeeze(gt))
+				if len(images) == batch_size:
+					yield np.array(images), gts
+					images, gts = [], []
+			if len(images):
+				yield np.array(images), gts
+
+		for images, gts in tqdm(batches(), disable = not verbose):
+			frontier = self.split.upstream(images, batch_size = batch_size)
+			predictions = self._select_output(self.split.downstream(frontier, batch_size = batch_size))
+
+			for n in range(len(images)):
+				actual, ablated = self._ablate_image([activation[n:n+1] for activation in frontier], 
+									predictions[n], gts[n], masks, batch_size)
+				delta = actual[None, :] - ablated
+
+				nsamples    += 1
+				actual_sum  += actual
+				ablated_sum += ablated
+				delta_sum   += delta
+				delta_sqsum += delta**2
+
+		if nsamples == 0:
+			raise ValueError("No samples found in data")
+
+		delta_mean = delta_sum/nsamples
+		delta_std  = np.sqrt(np.maximum(delta_sqsum/nsamples - delta_mean**2, 0))
+
+		dice_json = {'concept': [], 'class': [], 'actual': [], 'ablated': [], 
+				'delta': [], 'delta_std': [], 'nsamples': []}
+		for i in range(len(masks)):
+			for j, class_ in enumerate(classes):
+				dice_json['concept'].append(names[i])
+				dice_json['class'].append(class_)
+				dice_json['actual'].append(actual_sum[j]/nsamples)
+				dice_json['ablated'].append(ablated_sum[i, j]/nsamples)
+				dice_json['delta'].append(delta_mean[i, j])
+				dice_json['delta_std'].append(delta_std[i, j])
+				dice_json['nsamples'].append(nsamples)
+
+		df = pd.DataFrame(dice_json)
+		return df
+
 
 	def ablate_filters(self, filters_to_ablate = None, concept = 'random', step = None, save_path=None, verbose=1):
 		"""
@@ -75,8 +310,10 @@ class Ablate():
 		if filters_to_ablate == None:
 			filters_to_ablate = np.arange(0, self.filter_shape[-1], step)
 						
-		#predicts each volume and save the results in np array
-		prediction_unshaped, og_rec = self.model.predict(self.test_image, batch_size=1, verbose=verbose)
+		#predicts upstream activations once and reuse them for ablated prediction
+		frontier, prediction_unshaped = self._get_baseline(self.test_image)
+		if self.noutputs == 1:
+			prediction_unshaped = prediction_unshaped[0]
 
 
 		dice_json = {}
@@ -85,28 +322,23 @@ class Ablate():
 			dice_json[class_] = []
 			dice_json[class_] = []
 
-		occluded_weights = self.layer_weights.copy()
-
-		for j in (filters_to_ablate):
-			occluded_weights[0][:,:,:,j] = 0
-			occluded_weights[1][j] = 0
-
-		self.model.layers[self.layer_idx].set_weights(occluded_weights)			
-		prediction_unshaped_occluded, ab_rec = self.model.predict(self.test_image,batch_size=1, verbose=0)
+		# occlusion is applied on layer output, only downstream half is evaluated
+		prediction_unshaped_occluded = self.split.downstream(frontier, self.split.get_mask(filters_to_ablate))
+		if self.noutputs == 1:
+			prediction_unshaped_occluded = prediction_unshaped_occluded[0]
 
 		dice_json['concept'].append('actual_' + str(concept))
 		dice_json['concept'].append('ablated_' + str(concept))
 
-		for class_ in self.classinfo.keys():
-			if self.noutputs == 1:
-				dice_json[class_].append(self.metric(self.gt, prediction_unshaped.argmax(axis = -1), self.classinfo[class_]))
-				dice_json[class_].append(self.metric(self.gt, prediction_unshaped_occluded.argmax(axis = -1), self.classinfo[class_]))
-			else:
-				for ii in range(self.noutputs):
-					if prediction_unshaped[ii].shape[-1] == self.nclasses:
-						idx = ii
-				dice_json[class_].append(self.metric(self.gt, prediction_unshaped[idx].argmax(axis = -1), self.classinfo[class_]))
-				dice_json[class_].append(self.metric(self.gt, prediction_unshaped_occluded[idx].argmax(axis = -1), self.classinfo[class_]))
+		if self.noutputs == 1:
+			scores = self._get_scores(self.gt, np.concatenate([prediction_unshaped, 
+								prediction_unshaped_occluded], axis=0))
+		else:
+			scores = self._get_scores(self.gt, np.concatenate([self._select_output(prediction_unshaped), 
+								self._select_output(prediction_unshaped_occluded)], axis=0))
+
+		for j, class_ in enumerate(self.classinfo.keys()):
+			dice_json[class_].extend(list(scores[:, j]))
 
 		if not (save_path == None):
 			if self.noutputs > 1:
@@ -12,6 +12,8 @@ from glob import glob
 import SimpleITK as sitk
 import pandas as pd
 from ..helpers.utils import *
+from ..helpers.store import ActivationStore
+from ..helpers.sketch import QuantileSketch
 from keras.models import Model
 from skimage.transform import resize as imresize
 from keras.utils import np_utils
@@ -21,15 +23,92 @@ from scipy.ndimage.measurements import label
 from scipy.ndimage.morphology import binary_dilation, generate_binary_structure
 
 
+def perform_postprocessing(imgs, threshold=80):
+    """
+        connected component analysis with appropreate threshold, 
+        performed on all the channels at once
+
+        imgs      : binary maps (H x W x C)
+        threshold : area threshold for selecting max area 
+                components, largest component of each
+                channel is always selected
+    """
+    imgs = np.asarray(imgs)
+    structure = np.zeros((3, 3, 3))
+    structure[1] = generate_binary_structure(2, 1)
+
+    # channel first, components are never connected across channels
+    c, n = label(np.moveaxis(imgs, -1, 0), structure=structure)
+    sizes = np.bincount(c.ravel(), minlength=n + 1)
+
+    channels = np.zeros(n + 1, dtype='int64')
+    channels[c.ravel()] = np.repeat(np.arange(c.shape[0]), c[0].size)
+
+    selected = sizes > threshold
+    if n:
+        # largest component of each channel, lowest label on ties
+        labels  = np.arange(1, n + 1)
+        order   = np.lexsort((labels, -sizes[1:], channels[1:]))
+        ordered = channels[1:][order]
+        largest = order[np.r_[True, ordered[1:] != ordered[:-1]]]
+        selected[largest + 1] = True
+    selected[0] = False
+
+    return np.moveaxis(selected[c], 0, -1).astype(imgs.dtype)
+
+
+def resize_nearest(masks, shape):
+    """
+        nearest neighbour resize of all the channels at once,
+        same sampling as skimage resize with order=0
+
+        masks : maps in batch format (N x h x w x C)
+        shape : output spatial shape (H, W)
+    """
+    rows = np.floor((np.arange(shape[0]) + 0.5)*masks.shape[1]/float(shape[0])).astype('int64')
+    cols = np.floor((np.arange(shape[1]) + 0.5)*masks.shape[2]/float(shape[1])).astype('int64')
+    rows = np.clip(rows, 0, masks.shape[1] - 1)
+    cols = np.clip(cols, 0, masks.shape[2] - 1)
+    return masks[:, rows][:, :, cols]
+
+
+def dilate(masks):
+    """
+        dilation with 2x2 kernel of all the channels at once,
+        same as cv2.dilate with default anchor 
+
+        masks : maps in batch format (N x H x W x C)
+    """
+    dilated = masks.copy()
+    dilated[:, 1:] = np.maximum(dilated[:, 1:], masks[:, :-1])
+    shifted = dilated.copy()
+    dilated[:, :, 1:] = np.maximum(dilated[:, :, 1:], shifted[:, :, :-1])
+    return dilated
+
+
 class Dissector():
     """
         Network Dissection analysis
 
         model      : keras model initialized with trained weights
         layer_name : intermediate layer name which needs to be analysed
+        extractor  : shared FeatureExtractor tapping layer_name, activation
+                        stores of all the tapped layers are then filled
+                        in a single pass over the dataset
     """
 
-    def __init__(self, model, layer_name, seq=None):
+    def __init__(self, model, layer_name, seq=None, extractor=None):
+
+        self.layer_name = layer_name
+        self.seq = seq
+        self.extractor = extractor
+
+        if extractor is not None:
+            if not layer_name in extractor.layer_names:
+                raise ValueError("Layer {} is not tapped by given extractor".format(layer_name))
+            # shares layers (and weights) with the extractor model
+            self.model = Model(inputs=extractor.model.input, outputs=extractor.model.get_layer(layer_name).output)
+            return
 
         self.model = Model(inputs=model.input, outputs=model.get_layer(layer_name).output)
 
@@ -37,8 +116,13 @@ class Dissector():
             self.model.layers[i].set_weights(model.layers[i].get_weights())
             self.model.layers[i].trainable = False
 
-        self.layer_name = layer_name
-        self.seq = seq
+
+    def _predict(self, images, batch_size=8):
+        """
+            layer activations for images in batch format, only layers
+            up to layer_name are evaluated
+        """
+        return self.model.predict(images, batch_size = batch_size)
 
 
     def _perform_postprocessing(self, img, threshold=80):
@@ -49,23 +133,18 @@ class Dissector():
             threshold : area threshold for selecting max area 
                     components
         """
-
-        c,n = label(img)
-        nums = np.array([np.sum(c==i) for i in range(1, n+1)])
-        selected_components = np.array([threshold<num for num in nums])
-        selected_components[np.argmax(nums)] = True
-        mask = np.zeros_like(img)
-        for i,select in enumerate(selected_components):
-            if select:
-                mask[c==(i+1)]=1
-        return mask
+        return perform_postprocessing(img[..., None], threshold = threshold)[..., 0]
 
 
     def get_threshold_maps(self, 
                             dataset_path, 
                             save_path, 
                             percentile,
-                            loader=None):
+                            loader=None,
+                            approximate=False,
+                            nbins=32,
+                            max_samples=None,
+                            batch_size=8):
         """
             Estimates threshold maps for given percentile value
 
@@ -74,34 +153,90 @@ class Dissector():
                           if fmaps exists already it directly loads
             percentile  : value used for thresholding obtained feature maps
                           range: (0, 100)
+            approximate : if True thresholds are estimated with a streaming
+                          quantile sketch (bounded memory, no feature maps 
+                          are saved), error per channel is at most 
+                          range of channel activations / nbins
+            nbins       : number of histogram bins per cell of the sketch
+            max_samples : maximum number of images to consider, defaults
+                          to 500 for exact and all images for approximate
+            batch_size  : batch size used for approximate estimation and
+                          shared extractor
         """
-        if os.path.exists(os.path.join(save_path, 'ModelDissection_layer_fmaps_{}.npy'.format(self.layer_name))):
-            fmaps = np.load(os.path.join(save_path, 'ModelDissection_layer_fmaps_{}.npy'.format(self.layer_name))) 
+        if approximate:
+            return self._get_approximate_threshold_maps(dataset_path, save_path, percentile, 
+                                            loader, nbins = nbins, 
+                                            max_samples = -1 if max_samples is None else max_samples,
+                                            batch_size = batch_size)
+
+        legacy_path = os.path.join(save_path, 'ModelDissection_layer_fmaps_{}.npy'.format(self.layer_name))
+        if os.path.exists(legacy_path):
+            fmaps = np.load(legacy_path, mmap_mode='r')
+            return np.percentile(fmaps, percentile, axis=0)
+
+        store = self.get_activation_store(save_path)
+        if not store.complete and self.extractor is not None:
+            # fills stores of all the tapped layers in the same pass
+            store = self.extractor.get_activation_stores(dataset_path, loader, 
+                                            os.path.join(save_path, 'activations'),
+                                            max_samples = 500 if max_samples is None else max_samples,
+                                            batch_size = batch_size)[self.layer_name]
+        elif not store.complete:
+            store.reset()
+            for i, (input_, label_) in enumerate(load_dataset(dataset_path, loader, 
+                                            max_samples = 500 if max_samples is None else max_samples)):
+                print ("[INFO: BioExp] Slice no {} -- Working on {}".format(self.layer_name, i))
+                output = np.squeeze(self._predict(input_[None, ...]))
+                store.append(output[None, ...])
+            store.close()
 
-        else:
-            fmaps = []
-            input_paths = os.listdir(dataset_path)
+        threshold_maps = store.percentile(percentile)
+            
+        return threshold_maps
 
-            for i in range(len(input_paths) if len(input_paths) < 500 else 500):
-                print ("[INFO: BioExp] Slice no {} -- Working on {}".format(self.layer_name, i))
-                input_, label_ = loader(os.path.join(dataset_path, input_paths[i]), 
-					os.path.join(dataset_path, 
-					input_paths[i]).replace('mask', 'label').replace('labels', 'masks'))
-                output = np.squeeze(self.model.predict(input_[None, ...]))
-                fmaps.append(output)
 
-            fmaps = np.array(fmaps)
+    def _get_approximate_threshold_maps(self, dataset_path, save_path, percentile, loader, 
+                                            nbins=32, max_samples=-1, batch_size=8):
+        """
+            Estimates threshold maps with a streaming quantile sketch
+            updated batch by batch, estimated maps are saved in save_path
+        """
+        threshold_path = os.path.join(save_path, 
+                            'ModelDissection_layer_thresholds_{}_{}_{}.npy'.format(self.layer_name, percentile, nbins))
+        if os.path.exists(threshold_path):
+            return np.load(threshold_path)
+
+        sketch = QuantileSketch(nbins = nbins)
+        batch  = []
+        for i, (input_, label_) in enumerate(load_dataset(dataset_path, loader, max_samples = max_samples)):
+            batch.append(input_)
+            if len(batch) == batch_size:
+                print ("[INFO: BioExp] Slice no {} -- Working on {}".format(self.layer_name, i))
+                sketch.update(self._predict(np.array(batch), batch_size = batch_size))
+                batch = []
+        if len(batch):
+            sketch.update(self._predict(np.array(batch), batch_size = batch_size))
 
-            if not os.path.exists(save_path): 
-                os.makedirs(save_path)
+        threshold_maps = np.squeeze(sketch.percentile(percentile))
+        print ("[INFO: BioExp] Layer {} -- thresholds estimated from {} slices, max error per channel: {}".format(self.layer_name, 
+                                            sketch.nsamples, np.max(sketch.error_bound())))
 
-            np.save(os.path.join(save_path, 'ModelDissection_layer_fmaps_{}.npy'.format(self.layer_name)), fmaps)
+        if not os.path.exists(save_path): 
+            os.makedirs(save_path)
+        np.save(threshold_path, threshold_maps)
 
-        threshold_maps = np.percentile(fmaps, percentile, axis=0)
-            
         return threshold_maps
 
 
+    def get_activation_store(self, save_path):
+        """
+            chunked on-disk store of layer activations
+
+            save_path : root path of activation stores
+        """
+        return ActivationStore(os.path.join(save_path, 'activations'), self.layer_name)
+
+
     def _save_features(self, img, concepts, nrows, ncols, save_path=None):
         """
             creats a grid of image and saves if path is given
@@ -161,7 +296,7 @@ class Dissector():
             ROI :  region of interest mask in a given image
 
         """
-        fmaps = np.squeeze(self.model.predict(image[None, ...]))
+        fmaps = np.squeeze(self._predict(image[None, ...]))
         masks = fmaps >= threshold_maps
         masks = 1.*(masks)
 
@@ -173,14 +308,12 @@ class Dissector():
             nfeatures = fmaps.shape[-1]
 
 
-        for i in range(nfeatures):
-            resized_img = imresize(masks[:,:,i], shape, order=0)
-            try:
-                post_processed_img = self._perform_postprocessing(resized_img, 
+        resized_imgs = imresize(masks[:,:,:nfeatures], shape, order=0)
+        post_processed_imgs = perform_postprocessing(resized_imgs, 
                                          threshold = post_process_threshold)
-            except:
-                post_processed_img = resized_img
-            eroded_img = (cv2.dilate(post_processed_img, kernel, iterations=1))
+
+        for i in range(nfeatures):
+            eroded_img = (cv2.dilate(post_processed_imgs[:,:,i], kernel, iterations=1))
 
             try:
                 eroded_img = eroded_img*ROI 
@@ -219,7 +352,7 @@ class Dissector():
             ROI       : region of interest mask in a given image
         """
 
-        fmaps = np.squeeze(self.model.predict(image[None, ...]))
+        fmaps = np.squeeze(self._predict(image[None, ...]))
         masks = fmaps >= threshold_maps
         masks = 1.*(masks)
 
@@ -236,14 +369,12 @@ class Dissector():
             dice_json[class_] = []
 
 
-        for i in range(nfeatures):
-            resized_img = imresize(masks[:,:,i], shape, order=0)
-            try:
-                post_processed_img = self._perform_postprocessing(resized_img, 
+        resized_imgs = imresize(masks[:,:,:nfeatures], shape, order=0)
+        post_processed_imgs = perform_postprocessing(resized_imgs, 
                                          threshold = post_process_threshold)
-            except:
-                post_processed_img = resized_img
-            eroded_img = (cv2.dilate(post_processed_img, kernel, iterations=1))/255
+
+        for i in range(nfeatures):
+            eroded_img = (cv2.dilate(post_processed_imgs[:,:,i], kernel, iterations=1))/255
             try:
                 eroded_img = eroded_img*ROI 
             except: pass
@@ -271,3 +402,84 @@ class Dissector():
             self._save_features(image, resized_masks, nrows, ncols, save_fmaps)
 
         return resized_masks, df
+
+
+    def quantify_dataset(self, images, gts,
+                            threshold_maps,
+                            nclasses,
+                            nfeatures=None,
+                            save_path=None,
+                            post_process_threshold=80,
+                            ROI=None,
+                            batch_size=8):
+        """
+            Quatify the learnt internal concepts by a network over 
+            multiple images, only valid for segmentation networks 
+
+            images    : images in batch format (N x H x W x C)
+            gts       : ground truths (N x H x W)
+            threshold_maps : threshold maps used for dissection 
+            nclasses  : number of classes
+            nfeatures : number of feature maps to consider
+                        all if None
+            save_path : path to save csv with score for each image 
+                        and feature, not saved if None
+            post_process_threshold: threshold for postprocessing cc analysis
+            ROI       : region of interest masks (N x H x W) or (H x W)
+            batch_size: batch size for forward pass
+
+            returns dataframe with dice score of each feature 
+            of each image for all the classes
+        """
+
+        images = np.asarray(images)
+        gts    = np.asarray(gts).reshape(images.shape[:-1])
+        shape  = images.shape[1:-1]
+
+        classes = list(nclasses.keys())
+        dice_json = {'image': [], 'feature': []}
+        for class_ in classes:
+            dice_json[class_] = []
+
+        for st in range(0, len(images), batch_size):
+            fmaps = self._predict(images[st: st + batch_size], batch_size = batch_size)
+            if not nfeatures:
+                nfeatures = fmaps.shape[-1]
+
+            masks = 1.*(fmaps >= threshold_maps)[..., :nfeatures]
+            masks = resize_nearest(masks, shape)
+
+            # channels of all the images are postprocessed together
+            nimages = len(masks)
+            masks = np.moveaxis(masks, 0, -2).reshape(shape + (-1,))
+            masks = perform_postprocessing(masks, threshold = post_process_threshold)
+            masks = np.moveaxis(masks.reshape(shape + (nimages, nfeatures)), -2, 0)
+            masks = dilate(masks) > 0
+
+            if ROI is not None:
+                roi = np.asarray(ROI)
+                roi = roi[st: st + batch_size] if roi.ndim == 3 else roi[None, ...]
+                masks = masks*(roi[..., None] > 0)
+
+            gt = gts[st: st + batch_size]
+            class_masks = np.stack([np.isin(gt, nclasses[class_]) for class_ in classes], axis=-1)
+
+            masks = masks.astype(np.float32)
+            class_masks = class_masks.astype(np.float32)
+            intersection = np.einsum('nhwf,nhwk->nfk', masks, class_masks)
+            dice = (intersection + 1e-5)*2.0/(class_masks.sum(axis=(1, 2))[:, None, :] + \
+                                    masks.sum(axis=(1, 2))[:, :, None] + 1e-5)
+
+            dice_json['image'].extend(np.repeat(np.arange(st, st + nimages), nfeatures))
+            dice_json['feature'].extend(np.tile(np.arange(nfeatures), nimages))
+            for j, class_ in enumerate(classes):
+                dice_json[class_].extend(dice[:, :, j].ravel())
+
+        df = pd.DataFrame(dice_json)
+
+        if save_path:
+            if not os.path.exists(save_path): 
+                os.makedirs(save_path)
+            df.to_csv(os.path.join(save_path, self.layer_name+'_dataset_dice_scores.csv'), index=False)
+
+        return df
@@ -0,0 +1,83 @@
+import sys
+sys.path.append('../..')
+import math
+import time
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+from BioExp.clusters.customclustering import _UnionTracker_, agglomerate
+
+
+def legacy_agglomerate(simMatrix, heuristic='Centroid'):
+	"""
+		full upper triangle scan per merge, as used in
+		findMinDistance and mergeSimilarClusters before
+		the priority queue engine
+	"""
+	simMatrix = np.array(simMatrix, dtype=float)
+	n = simMatrix.shape[0]
+	Uni = _UnionTracker_(n)
+	ids = list(range(n))
+	members = [1]*n
+
+	for iteration in range(n-1):
+		minDistance, clusterA, clusterB = 1*math.inf, None, None
+		for rowNumber in range(0, n-1):
+			for colNumber in range(rowNumber+1, n):
+				if simMatrix[rowNumber, colNumber] < minDistance:
+					minDistance = simMatrix[rowNumber, colNumber]
+					clusterA, clusterB = rowNumber, colNumber
+
+		m, d = clusterA, clusterB
+		if heuristic == 'Centroid':
+			rowSum = (simMatrix[m, :]*members[m] + simMatrix[d, :]*members[d])/(members[m]+members[d])
+		elif heuristic == 'Max':
+			rowSum = np.amax(np.vstack((simMatrix[m, :], simMatrix[d, :])), axis=0)
+		elif heuristic == 'Min':
+			rowSum = np.amin(np.vstack((simMatrix[m, :], simMatrix[d, :])), axis=0)
+		simMatrix[:, m] = rowSum
+		simMatrix[m, :] = rowSum
+		simMatrix[:, d] = 1*math.inf
+		simMatrix[d, :] = 1*math.inf
+
+		members[m] += members[d]
+		Uni.union(ids[d], ids[m], minDistance, members[m], iteration)
+		ids[m] = n + iteration
+	return Uni
+
+
+def filter_features(nfilters=256, seed=0):
+	"""
+		flattened 3x3x32 filters with position encoding,
+		as clustered in customclustering.Cluster
+	"""
+	rng = np.random.RandomState(seed)
+	X = rng.randn(nfilters, 3*3*32)
+	return X + np.linspace(0, X.shape[-1], X.shape[-1])[None, :]
+
+
+simMatrix = squareform(pdist(filter_features()))
+
+# ties, every distance is one of a few values
+ties = np.round(simMatrix/simMatrix.max()*4)
+np.fill_diagonal(ties, 0)
+
+print ("[INFO: BioExp Benchmark] 256 filters")
+for heuristic in ['Centroid', 'Max', 'Min']:
+	for name, matrix in [('distinct', simMatrix), ('tied', ties)]:
+		start = time.time()
+		legacy = legacy_agglomerate(matrix, heuristic)
+		legacy_time = time.time() - start
+
+		start = time.time()
+		engine = agglomerate(matrix, heuristic)
+		engine_time = time.time() - start
+
+		assert np.array_equal(legacy.linkage_matrix, engine.linkage_matrix)
+		print ("{} ({} distances) -- full scan: {:.3f}s, priority queue: {:.3f}s, speedup: {:.1f}x".format(heuristic,
+					name, legacy_time, engine_time, legacy_time/engine_time))
+
+for nfilters in [512, 2048]:
+	simMatrix = squareform(pdist(filter_features(nfilters)))
+	start = time.time()
+	agglomerate(simMatrix, 'Centroid')
+	print ("[INFO: BioExp Benchmark] {} filters, priority queue: {:.3f}s".format(nfilters, time.time() - start))
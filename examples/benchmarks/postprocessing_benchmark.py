@@ -0,0 +1,51 @@
+import sys
+sys.path.append('../..')
+import time
+import numpy as np
+from scipy.ndimage.measurements import label
+from BioExp.spatial.dissection import perform_postprocessing
+
+
+def legacy_postprocessing(img, threshold=80):
+	"""
+		per channel connected component analysis, as used in 
+		Dissector before vectorization
+	"""
+	c,n = label(img)
+	nums = np.array([np.sum(c==i) for i in range(1, n+1)])
+	selected_components = np.array([threshold<num for num in nums])
+	selected_components[np.argmax(nums)] = True
+	mask = np.zeros_like(img)
+	for i,select in enumerate(selected_components):
+		if select:
+			mask[c==(i+1)]=1
+	return mask
+
+
+def random_masks(shape=(240, 240, 64), percentile=85, seed=0):
+	"""
+		thresholded smooth random activations, similar to 
+		dissection masks
+	"""
+	rng = np.random.RandomState(seed)
+	fmaps = rng.rand(shape[0]//8, shape[1]//8, shape[2])
+	fmaps = np.kron(fmaps, np.ones((8, 8, 1))) + 0.5*rng.rand(*shape)
+	return 1.*(fmaps >= np.percentile(fmaps, percentile, axis=(0, 1)))
+
+
+masks = random_masks()
+
+start = time.time()
+legacy = np.zeros_like(masks)
+for i in range(masks.shape[-1]):
+	legacy[:,:,i] = legacy_postprocessing(masks[:,:,i])
+legacy_time = time.time() - start
+
+start = time.time()
+vectorized = perform_postprocessing(masks)
+vectorized_time = time.time() - start
+
+assert np.array_equal(legacy, vectorized)
+print ("[INFO: BioExp Benchmark] 64-channel 240x240 layer")
+print ("per channel loop: {:.3f}s, vectorized: {:.3f}s, speedup: {:.1f}x".format(legacy_time, 
+				vectorized_time, legacy_time/vectorized_time))